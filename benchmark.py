@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+"""
+Офлайн-бенчмарк Telegram Comment Monitor
+Прогоняет синтетические комментарии через CommentMonitor без живого Telegram:
+Bot API заменяется локальным aiohttp-сервером, Telethon - поддельным клиентом
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from aiohttp import web
+from telethon.crypto import AuthKey
+from telethon.sessions import StringSession
+from telethon.tl.types import (
+    Document,
+    DocumentAttributeAnimated,
+    DocumentAttributeAudio,
+    DocumentAttributeFilename,
+    DocumentAttributeSticker,
+    DocumentAttributeVideo,
+    InputStickerSetEmpty,
+    MessageFwdHeader,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    MessageMediaUnsupported,
+    MessageReplyHeader,
+    PeerChannel,
+    Photo,
+    PhotoSize,
+    User,
+)
+
+# Размеры синтетических медиафайлов по типам, байты
+MEDIA_SIZES = {
+    "photo": 200 * 1024,
+    "video": 3 * 1024 * 1024,
+    "voice": 60 * 1024,
+    "sticker": 40 * 1024,
+    "gif": 800 * 1024,
+    "audio": 4 * 1024 * 1024,
+    "document": 500 * 1024,
+}
+
+DEFAULT_MIX = "text=50,photo=20,video=8,voice=8,sticker=8,gif=3,document=3"
+
+# ID групп обсуждений на стенде
+BENCH_CHATS = [-1001000000001, -1001000000002, -1001000000003]
+
+
+class FakeBotApi:
+    """Локальная замена api.telegram.org с настраиваемой задержкой, 429 и ошибками"""
+
+    def __init__(self, latency: float, jitter: float, rate_429: float, error_rate: float, retry_after: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls: Dict[str, int] = {}
+        self.bot_calls: Dict[str, int] = {}
+        self.injected_429 = 0
+        self.injected_errors = 0
+        self.bytes_received = 0
+        self.file_ids = itertools.count(1)
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self, port: int = 0):
+        app = web.Application(client_max_size=100 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{bound_port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        body = await request.read()
+        self.bytes_received += len(body)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        bot_id = request.match_info["token"].split(":", 1)[0]
+        self.bot_calls[bot_id] = self.bot_calls.get(bot_id, 0) + 1
+
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+        roll = random.random()
+        if roll < self.rate_429:
+            self.injected_429 += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        if roll < self.rate_429 + self.error_rate:
+            self.injected_errors += 1
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500
+            )
+        return web.json_response({"ok": True, "result": self._result(method)})
+
+    def _result(self, method: str):
+        def file_entry():
+            return {"file_id": f"bench-{next(self.file_ids)}", "file_unique_id": "u"}
+
+        if method == "sendPhoto":
+            return {"message_id": 1, "photo": [file_entry()]}
+        if method == "sendVideo":
+            return {"message_id": 1, "video": file_entry()}
+        if method == "sendVoice":
+            return {"message_id": 1, "voice": file_entry()}
+        if method == "sendDocument":
+            return {"message_id": 1, "document": file_entry()}
+        if method == "sendMediaGroup":
+            return [{"message_id": 1, "photo": [file_entry()]}]
+        return {"message_id": 1}
+
+
+class FakeTelegramClient:
+    """Поддельный Telethon-клиент: отдает синтетические данные с задержкой MTProto"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+
+    def _count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def get_messages(self, peer, ids):
+        self._count("get_messages")
+        await asyncio.sleep(self.latency)
+        ids_list = ids if isinstance(ids, list) else [ids]
+        result = [
+            FakeOriginal(fwd_from=MessageFwdHeader(date=datetime.now(timezone.utc), channel_post=post_id + 100000))
+            for post_id in ids_list
+        ]
+        return result if isinstance(ids, list) else result[0]
+
+    async def iter_download(self, media, chunk_size: int = 512 * 1024):
+        self._count("iter_download")
+        size = media_size(media)
+        sent = 0
+        while sent < size:
+            await asyncio.sleep(self.latency / 4)
+            chunk = min(chunk_size, size - sent)
+            sent += chunk
+            yield b"\0" * chunk
+
+    async def send_file(self, chat_id, media, **kwargs):
+        self._count("send_file")
+        await asyncio.sleep(self.latency)
+
+    async def forward_messages(self, chat_id, messages, **kwargs):
+        self._count("forward_messages")
+        await asyncio.sleep(self.latency)
+
+    def is_connected(self) -> bool:
+        return True
+
+
+class FakeOriginal:
+    """Оригинальное сообщение поста в группе обсуждений"""
+
+    def __init__(self, fwd_from):
+        self.fwd_from = fwd_from
+
+
+class FakeMessage:
+    """Синтетическое сообщение с тем набором полей, который использует CommentMonitor"""
+
+    def __init__(self, client: FakeTelegramClient, message_id: int, chat_id: int, post_id: Optional[int],
+                 sender: User, text: str, media, date: datetime, top_id: Optional[int] = None):
+        self.client = client
+        self.id = message_id
+        self.chat_id = chat_id
+        self.peer_id = PeerChannel(abs(chat_id) - 1000000000000)
+        self.reply_to = (
+            MessageReplyHeader(reply_to_msg_id=post_id, reply_to_top_id=top_id) if post_id else None
+        )
+        self.sender = sender
+        self.sender_id = sender.id
+        self.text = text
+        self.message = text
+        self.media = media
+        self.date = date
+
+    async def get_sender(self):
+        await asyncio.sleep(self.client.latency)
+        return self.sender
+
+    async def download_media(self, file=None, thumb=None):
+        self.client._count("download_media")
+        size = media_size(self.media, thumb)
+        await asyncio.sleep(self.client.latency + size / (20 * 1024 * 1024))
+        file.write(b"\0" * size)
+        return file
+
+
+class FakeEvent:
+    """Событие events.NewMessage в объеме, нужном обработчику"""
+
+    def __init__(self, message: FakeMessage):
+        self.message = message
+        self.chat_id = message.chat_id
+
+
+def media_size(media, thumb=None) -> int:
+    if isinstance(media, MessageMediaPhoto):
+        return media.photo.sizes[-1].size
+    if isinstance(media, MessageMediaDocument):
+        if thumb is not None and media.document.thumbs:
+            return media.document.thumbs[-1].size
+        return media.document.size
+    return 0
+
+
+def make_media(kind: str, media_id: int, size: Optional[int] = None, mime: Optional[str] = None,
+               has_thumb: Optional[bool] = None):
+    """Создает настоящие объекты Telethon для заданного типа медиа
+    
+    Без size, mime и has_thumb берутся типовые значения стенда.
+    """
+    size = MEDIA_SIZES.get(kind, 0) if size is None else size
+    now = datetime.now(timezone.utc)
+    if kind == "text":
+        return None
+    if kind == "other":
+        # Опросы, геолокации, веб-превью и т.п. - конвейер отправляет для них fallback
+        return MessageMediaUnsupported()
+    if kind == "photo":
+        photo = Photo(
+            id=media_id, access_hash=media_id, file_reference=b"", date=now,
+            sizes=[PhotoSize(type="y", w=1280, h=960, size=size)], dc_id=2
+        )
+        return MessageMediaPhoto(photo=photo)
+
+    attributes = {
+        "video": [DocumentAttributeVideo(duration=10, w=640, h=360), DocumentAttributeFilename("video.mp4")],
+        "voice": [DocumentAttributeAudio(duration=5, voice=True)],
+        "audio": [DocumentAttributeAudio(duration=180), DocumentAttributeFilename("track.mp3")],
+        "sticker": [DocumentAttributeSticker(alt="", stickerset=InputStickerSetEmpty())],
+        "gif": [DocumentAttributeAnimated(), DocumentAttributeFilename("anim.mp4")],
+        "document": [DocumentAttributeFilename("report.pdf")],
+    }[kind]
+    mime = mime or {
+        "video": "video/mp4", "voice": "audio/ogg", "audio": "audio/mpeg", "sticker": "image/webp",
+        "gif": "video/mp4", "document": "application/pdf",
+    }[kind]
+    if has_thumb is None:
+        has_thumb = kind in ("video", "document")
+    thumbs = [PhotoSize(type="m", w=320, h=180, size=15 * 1024)] if has_thumb else None
+    document = Document(
+        id=media_id, access_hash=media_id, file_reference=b"", date=now,
+        mime_type=mime, size=size, dc_id=2, attributes=attributes, thumbs=thumbs
+    )
+    return MessageMediaDocument(document=document)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind != "text" and kind not in MEDIA_SIZES:
+            raise ValueError(f"Неизвестный тип сообщения в --mix: {kind}")
+        weights[kind] = float(weight)
+    return weights
+
+
+class SyntheticTraffic:
+    """Генератор синтетических комментариев по заданной смеси типов"""
+
+    def __init__(self, client: FakeTelegramClient, mix: Dict[str, float], repeat_media: float):
+        self.client = client
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.repeat_media = repeat_media
+        self.message_ids = itertools.count(1)
+        self.media_ids = itertools.count(1)
+        # Небольшой пул повторяющихся стикеров/GIF/мемов для кэша file_id
+        self.popular_media: Dict[str, list[int]] = {}
+        self.senders = [
+            User(id=1000 + i, first_name=f"User{i}", last_name=None, username=f"user{i}")
+            for i in range(50)
+        ]
+
+    def next_message(self) -> FakeMessage:
+        kind = random.choices(self.kinds, self.weights)[0]
+        media = None
+        if kind != "text":
+            pool = self.popular_media.setdefault(kind, [])
+            if pool and random.random() < self.repeat_media:
+                media_id = random.choice(pool)
+            else:
+                media_id = next(self.media_ids)
+                if len(pool) < 20:
+                    pool.append(media_id)
+            media = make_media(kind, media_id)
+        return FakeMessage(
+            client=self.client,
+            message_id=next(self.message_ids),
+            chat_id=random.choice(BENCH_CHATS),
+            post_id=random.randint(1, 30),
+            sender=random.choice(self.senders),
+            text="Синтетический комментарий для бенчмарка" if kind == "text" or random.random() < 0.3 else "",
+            media=media,
+            date=datetime.now(timezone.utc),
+        )
+
+
+def bench_groups() -> list[Tuple[int, str, str]]:
+    """Группы обсуждений синтетического стенда: (chat_id, username канала, название)"""
+    return [(chat_id, f"bench{index}", f"Bench channel {index}") for index, chat_id in enumerate(BENCH_CHATS)]
+
+
+def prepare_environment(bot_api_url: str, state_dir: str, extra_env: Dict[str, str], real_limits: bool,
+                        verbose: bool, channels: list[str]):
+    """Заполняет переменные окружения для Config фиктивными значениями стенда"""
+    session = StringSession()
+    session.set_dc(2, "127.0.0.1", 443)
+    session.auth_key = AuthKey(bytes(256))
+    env = {
+        "TG_API_ID": "1",
+        "TG_API_HASH": "bench",
+        "TG_STRING_SESSION": session.save(),
+        "BOT_TOKEN": "1:bench",
+        "ALERT_CHAT_ID": "-1009999999999",
+        "CHANNELS": ",".join(channels),
+        "BOT_API_URL": bot_api_url,
+        "STATE_DIR": state_dir,
+        "STATS_INTERVAL": "0",
+        "CATCHUP_ENABLED": "false",
+        "LOG_LEVEL": "INFO" if verbose else "WARNING",
+    }
+    if not real_limits:
+        # Без этого пропускная способность упирается в 20 сообщений/мин на чат
+        env["BOT_API_CHAT_RATE"] = "1000000"
+        env["BOT_API_GLOBAL_RATE"] = "1000000"
+    env.update(extra_env)
+    os.environ.update(env)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux - килобайты, в macOS - байты
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform != "darwin" else rss / (1024 * 1024)
+
+
+async def create_monitor(fake_client: FakeTelegramClient, groups: list[Tuple[int, str, str]]):
+    """Создает CommentMonitor на стенде: поддельный клиент, группы без резолва"""
+    import worker
+
+    config = worker.Config()
+    monitor = worker.CommentMonitor(config)
+    # Логирование как в боевом запуске: очередь и отдельный поток записи
+    monitor.log_listener = worker.configure_logging(config)
+    shard = monitor.shards[0]
+    shard.client = fake_client
+    monitor.client = fake_client
+    for chat_id, username, title in groups:
+        monitor._register_group(username, shard, chat_id, chat_id, username, title)
+    await monitor._open_delivery()
+    monitor._start_workers()
+    return monitor
+
+
+# Расписание подачи: (секунды от старта, функция, создающая сообщение в момент подачи)
+Schedule = Iterable[Tuple[float, Callable[[], FakeMessage]]]
+
+
+def synthetic_schedule(traffic: SyntheticTraffic, rate: float, count: int) -> Schedule:
+    return ((index / rate, traffic.next_message) for index in range(count))
+
+
+async def drive(monitor, schedule: Schedule) -> Dict:
+    """Подает сообщения по расписанию и ждет их полной обработки"""
+    arrivals: Dict[Tuple[int, int], float] = {}
+    latencies: list[float] = []
+    process_job = monitor._process_job
+
+    async def timed_process_job(job):
+        try:
+            await process_job(job)
+        finally:
+            latencies.append(time.monotonic() - arrivals[(job.chat_id, job.message.id)])
+
+    monitor._process_job = timed_process_job
+
+    count = 0
+    started = time.monotonic()
+    for offset, make_message in schedule:
+        delay = started + offset - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = make_message()
+        arrivals[(message.chat_id, message.id)] = time.monotonic()
+        await monitor._handle_new_message(FakeEvent(message))
+        count += 1
+
+    await monitor.queue.join()
+    if monitor.digest:
+        await monitor.digest.flush_all()
+    elapsed = time.monotonic() - started
+
+    return {
+        "comments": count,
+        "elapsed_s": round(elapsed, 3),
+        "comments_per_s": round(count / elapsed, 2) if elapsed else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+async def run_stand(args, groups: list[Tuple[int, str, str]],
+                    make_schedule: Callable[[FakeTelegramClient], Schedule]) -> Dict:
+    """Поднимает стенд (локальный Bot API, поддельный клиент, монитор) и прогоняет расписание"""
+    fake_api = FakeBotApi(args.api_latency, args.api_jitter, args.rate_429, args.error_rate, args.retry_after)
+    await fake_api.start()
+
+    with tempfile.TemporaryDirectory(prefix="tgmon-bench-") as state_dir:
+        extra_env = dict(item.split("=", 1) for item in args.env)
+        channels = [username for _, username, _ in groups]
+        prepare_environment(fake_api.url, state_dir, extra_env, args.real_limits, args.verbose, channels)
+
+        fake_client = FakeTelegramClient(args.mtproto_latency)
+        monitor = await create_monitor(fake_client, groups)
+        try:
+            result = await drive(monitor, make_schedule(fake_client))
+        finally:
+            await monitor._shutdown()
+            monitor.log_listener.stop()
+            await fake_api.stop()
+
+    result.update({
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "bot_api_calls": fake_api.calls,
+        "bot_api_calls_per_bot": fake_api.bot_calls,
+        "bot_api_429": fake_api.injected_429,
+        "bot_api_errors": fake_api.injected_errors,
+        "bot_api_bytes_received": fake_api.bytes_received,
+        "mtproto_calls": fake_client.calls,
+    })
+    return result
+
+
+async def run_benchmark(args) -> Dict:
+    def make_schedule(fake_client: FakeTelegramClient) -> Schedule:
+        traffic = SyntheticTraffic(fake_client, parse_mix(args.mix), args.repeat_media)
+        return synthetic_schedule(traffic, args.rate, args.count)
+
+    return await run_stand(args, bench_groups(), make_schedule)
+
+
+def add_stand_arguments(parser: argparse.ArgumentParser):
+    """Параметры стенда, общие для бенчмарка и replay.py"""
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Средняя задержка Bot API, с")
+    parser.add_argument("--api-jitter", type=float, default=0.02, help="Разброс задержки Bot API, с")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--mtproto-latency", type=float, default=0.03, help="Задержка запросов MTProto, с")
+    parser.add_argument("--real-limits", action="store_true",
+                        help="Оставить боевые лимиты Bot API (по умолчанию сняты)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed генератора случайных чисел")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Дополнительные переменные окружения монитора (можно несколько)")
+    parser.add_argument("--loop", choices=("asyncio", "uvloop"), default="asyncio",
+                        help="Реализация event loop (uvloop должен быть установлен)")
+    parser.add_argument("--json", metavar="PATH", help="Сохранить результат в JSON для сравнения версий")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Показывать логи монитора (уровень INFO, категории - через --env LOG_CATEGORIES=...)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк Telegram Comment Monitor")
+    parser.add_argument("--count", type=int, default=500, help="Сколько комментариев подать")
+    parser.add_argument("--rate", type=float, default=50.0, help="Целевая частота, комментариев/с")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Смесь типов: text=50,photo=20,...")
+    parser.add_argument("--repeat-media", type=float, default=0.5,
+                        help="Доля медиа из пула повторяющихся (стикеры, мемы)")
+    add_stand_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def run_and_report(args, run, title: str):
+    """Запускает прогон в выбранном event loop, печатает и сохраняет результат"""
+    random.seed(args.seed)
+
+    if args.loop == "uvloop":
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    result = asyncio.run(run(args))
+
+    print("=" * 50)
+    print(title)
+    print("=" * 50)
+    for key, value in result.items():
+        print(f"{key}: {value}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+def main(argv=None):
+    run_and_report(parse_args(argv), run_benchmark, "Результаты бенчмарка")
+
+
+if __name__ == "__main__":
+    main()
@@ -75,6 +75,8 @@ echo "📦 Установка зависимостей Python..."
 source venv/bin/activate
 pip install --upgrade pip
 pip install -r requirements.txt
+# Необязательный ускоритель event loop: без него монитор работает на asyncio
+pip install uvloop || echo "⚠️ uvloop не установлен, будет использован asyncio"
 
 # Создание файла .env
 if [ ! -f "$PROJECT_DIR/.env" ]; then
@@ -131,6 +133,7 @@ User=$USER
 WorkingDirectory=$PROJECT_DIR
 EnvironmentFile=$PROJECT_DIR/.env
 ExecStart=$PROJECT_DIR/venv/bin/python $PROJECT_DIR/worker.py
+ExecReload=/bin/kill -HUP \$MAINPID
 Restart=always
 RestartSec=10
 StandardOutput=journal
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанного трафика Telegram Comment Monitor
+Подает события из trace-файла (TRACE_FILE) в CommentMonitor на стенде бенчмарка:
+с исходными интервалами, ускоренно или без пауз. Содержимое медиа заменяется
+синтетическими байтами того же размера
+"""
+
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Tuple
+
+from telethon.tl.types import User
+
+from benchmark import (
+    FakeMessage,
+    FakeTelegramClient,
+    Schedule,
+    add_stand_arguments,
+    make_media,
+    run_and_report,
+    run_stand,
+)
+
+
+def load_trace(path: str, limit: int) -> list[dict]:
+    """Читает события trace-файла по порядку получения; битые строки пропускаются
+    
+    Строки разных сессий в файле могут чередоваться не по времени, поэтому
+    limit отсчитывается после сортировки: это самые ранние события записи.
+    """
+    events = []
+    skipped = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # Последняя строка может быть недописана, если процесс был убит
+                skipped += 1
+    if skipped:
+        print(f"Пропущено поврежденных строк: {skipped}", file=sys.stderr)
+    events.sort(key=lambda event: event["t"])
+    return events[:limit] if limit else events
+
+
+def trace_groups(events: list[dict]) -> list[Tuple[int, str, str]]:
+    """Группы обсуждений из trace: (chat_id, username канала, название)"""
+    groups: Dict[int, str] = {}
+    for event in events:
+        if event["c"] not in groups:
+            groups[event["c"]] = event.get("ch") or f"trace{len(groups)}"
+    return [(chat_id, username, username) for chat_id, username in groups.items()]
+
+
+def trace_stats(events: list[dict]) -> Dict:
+    """Длительность записи и пиковая частота событий за секунду"""
+    if not events:
+        return {"trace_events": 0, "trace_span_s": 0.0, "trace_peak_per_s": 0}
+    per_second: Dict[int, int] = {}
+    for event in events:
+        second = int(event["t"])
+        per_second[second] = per_second.get(second, 0) + 1
+    return {
+        "trace_events": len(events),
+        "trace_span_s": round(events[-1]["t"] - events[0]["t"], 3),
+        "trace_peak_per_s": max(per_second.values()),
+    }
+
+
+def build_message(client: FakeTelegramClient, event: dict) -> FakeMessage:
+    """Восстанавливает сообщение из события; дата сдвигается к текущему моменту с тем же отставанием"""
+    kind = event.get("k")
+    media = None
+    if kind:
+        media = make_media(
+            kind, event.get("mid") or event["id"], event.get("z"), event.get("mt"), bool(event.get("th"))
+        )
+    sender_id = event.get("s") or 0
+    sender = User(
+        id=sender_id,
+        first_name=event.get("fn") or f"User{sender_id}",
+        last_name=None,
+        username=event.get("un"),
+    )
+    lag = max(0.0, event["t"] - event["d"])
+    return FakeMessage(
+        client=client,
+        message_id=event["id"],
+        chat_id=event["c"],
+        post_id=event.get("r"),
+        top_id=event.get("top"),
+        sender=sender,
+        text=event.get("x", ""),
+        media=media,
+        date=datetime.now(timezone.utc) - timedelta(seconds=lag),
+    )
+
+
+def trace_schedule(events: list[dict], speed: float) -> Callable[[FakeTelegramClient], Schedule]:
+    """Расписание подачи: исходные интервалы, деленные на speed (0 - без пауз)"""
+    def make_schedule(client: FakeTelegramClient) -> Schedule:
+        started = events[0]["t"] if events else 0.0
+        for event in events:
+            offset = (event["t"] - started) / speed if speed > 0 else 0.0
+            yield offset, lambda event=event: build_message(client, event)
+
+    return make_schedule
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизведение trace-файла Telegram Comment Monitor")
+    parser.add_argument("trace", help="Файл, записанный с TRACE_FILE")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Ускорение относительно записи: 1 - как в записи, 10 - в 10 раз быстрее, 0 - без пауз")
+    parser.add_argument("--limit", type=int, default=0, help="Воспроизвести только N самых ранних событий")
+    add_stand_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    events = load_trace(args.trace, args.limit)
+    if not events:
+        print(f"В {args.trace} нет событий", file=sys.stderr)
+        sys.exit(1)
+
+    async def run_replay(args) -> Dict:
+        result = await run_stand(args, trace_groups(events), trace_schedule(events, args.speed))
+        result.update(trace_stats(events))
+        return result
+
+    run_and_report(args, run_replay, "Результаты воспроизведения")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,51 @@ Telegram Comment Monitor
 Мониторинг комментариев в дискуссионных группах Telegram-каналов
 """
 
+import time
+
+# Отсчет холодного старта для STARTUP_PROFILE - до импорта остальных модулей
+_IMPORT_STARTED = time.perf_counter()
+
 import asyncio
+import bisect
+import hashlib
+import json
 import os
+import re
+import signal
+import sqlite3
 import sys
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Optional, Tuple
 import logging
+import logging.handlers
+import queue
 from io import BytesIO
 
 import aiohttp
 import pytz
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, utils
 from telethon.sessions import StringSession
 from telethon.tl.functions.channels import GetFullChannelRequest, JoinChannelRequest
-from telethon.tl.types import Channel, MessageMediaPhoto, MessageMediaDocument
+from telethon.tl.types import (
+    Channel,
+    DocumentAttributeAnimated,
+    DocumentAttributeAudio,
+    DocumentAttributeFilename,
+    DocumentAttributeSticker,
+    DocumentAttributeVideo,
+    InputChannel,
+    InputPeerChannel,
+    MessageMediaPhoto,
+    MessageMediaDocument,
+    MessageService,
+)
 from telethon.errors import (
     ChannelPrivateError,
     InviteHashExpiredError,
@@ -25,6 +56,8 @@ from telethon.errors import (
     UserAlreadyParticipantError,
 )
 
+_IMPORT_FINISHED = time.perf_counter()
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -32,6 +65,162 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 logger = logging.getLogger(__name__)
+# Категории горячего пути: прием событий, обработка медиа, доставка в Bot API.
+# Уровень каждой настраивается отдельно через LOG_CATEGORIES
+event_log = logging.getLogger(f"{__name__}.event")
+media_log = logging.getLogger(f"{__name__}.media")
+delivery_log = logging.getLogger(f"{__name__}.delivery")
+LOG_CATEGORIES = ("event", "media", "delivery")
+
+# Идентификатор комментария, который обрабатывает текущая задача (для ключей outbox)
+current_comment: ContextVar[str] = ContextVar("current_comment", default="")
+# Бот, через который прошел последний успешный вызов Bot API в этой задаче
+# (file_id действителен только для бота, который его получил)
+current_bot: ContextVar[Optional["BotSlot"]] = ContextVar("current_bot", default=None)
+# Чат, в который сейчас отправляется уведомление (0 - ALERT_CHAT_ID)
+current_target_chat: ContextVar[int] = ContextVar("current_target_chat", default=0)
+# Время публикации этого комментария (unix time) для метрики end-to-end латентности
+current_message_time: ContextVar[float] = ContextVar("current_message_time", default=0.0)
+# Попал ли текущий комментарий в выборку подробного DEBUG-логирования
+log_sampled: ContextVar[bool] = ContextVar("log_sampled", default=True)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который откладывает форматирование записи в поток слушателя
+    
+    В event loop остается только подстановка аргументов сообщения и захват
+    контекста комментария; время, JSON и запись в поток делает QueueListener.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        record.comment = current_comment.get()
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Структурированный вывод: одна JSON-строка на запись"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "category": record.name.rpartition(".")[2] if record.name != __name__ else "main",
+            "msg": record.getMessage(),
+        }
+        comment = getattr(record, "comment", "")
+        if comment:
+            entry["comment"] = comment
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SampledFilter(logging.Filter):
+    """Пропускает DEBUG-записи только комментариев, попавших в выборку"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or log_sampled.get()
+
+
+class LogSampler:
+    """Ограничивает число комментариев в секунду, для которых пишется подробный лог"""
+    
+    def __init__(self, per_second: int):
+        self.per_second = per_second
+        self.window_start = 0.0
+        self.window_count = 0
+        self.suppressed = 0
+    
+    def sample(self) -> bool:
+        if self.per_second <= 0:
+            return True
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start = now
+            self.window_count = 0
+        if self.window_count < self.per_second:
+            self.window_count += 1
+            return True
+        self.suppressed += 1
+        return False
+    
+    def report(self) -> str:
+        return f"подробный лог пропущен для {self.suppressed} комментариев"
+
+
+def configure_logging(config: "Config") -> logging.handlers.QueueListener:
+    """Переводит логирование на очередь: запись в stdout идет из отдельного потока
+    
+    Обработчики, созданные basicConfig, переезжают в QueueListener, а корневой
+    логгер получает неблокирующий DeferredQueueHandler.
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if config.log_format == "json":
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root.handlers = [DeferredQueueHandler(log_queue)]
+    root.setLevel(config.log_level)
+    for category, level in config.log_categories.items():
+        logging.getLogger(f"{__name__}.{category}").setLevel(level)
+    for category_logger in (event_log, media_log):
+        category_logger.addFilter(SampledFilter())
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def install_event_loop(choice: str) -> str:
+    """Выбирает реализацию event loop до asyncio.run (EVENT_LOOP=auto|asyncio|uvloop)
+    
+    auto берет uvloop, если он установлен. Возвращает имя выбранного loop.
+    """
+    if choice not in ("auto", "uvloop"):
+        return "asyncio"
+    try:
+        import uvloop
+    except ImportError:
+        if choice == "uvloop":
+            logger.warning("EVENT_LOOP=uvloop, но uvloop не установлен: используется asyncio")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+
+class StartupProfiler:
+    """Длительность фаз холодного старта для STARTUP_PROFILE
+    
+    Замер - пара вызовов perf_counter на фазу, поэтому фазы пишутся всегда,
+    а отчет выводится только при включенном профилировании.
+    """
+    
+    def __init__(self, started: float):
+        self.started = started
+        self.phases: list[Tuple[str, float]] = []
+    
+    def record(self, name: str, seconds: float):
+        self.phases.append((name, seconds))
+    
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+    
+    def report(self) -> list[str]:
+        """Строки отчета: фазы по порядку и время от начала импорта до готовности"""
+        lines = [f"  - {name}: {seconds:.3f} с" for name, seconds in self.phases]
+        lines.append(f"  = готов к приему событий через {time.perf_counter() - self.started:.3f} с")
+        return lines
+
+
+startup_profile = StartupProfiler(_IMPORT_STARTED)
+startup_profile.record("import", _IMPORT_FINISHED - _IMPORT_STARTED)
 
 
 class Config:
@@ -41,10 +230,129 @@ class Config:
         self.api_id = self._get_env_int("TG_API_ID")
         self.api_hash = self._get_env("TG_API_HASH")
         self.string_session = self._get_env("TG_STRING_SESSION")
+        # Пул сессий: основная и дополнительные аккаунты, каналы делятся между ними
+        self.string_sessions = [self.string_session] + [
+            session.strip() for session in os.getenv("TG_EXTRA_SESSIONS", "").split(",") if session.strip()
+        ]
+        # FloodWait такой длительности (секунды) переносит каналы сессии на другие аккаунты
+        self.shard_flood_rebalance = self._get_env_int_optional("SHARD_FLOOD_REBALANCE", 300)
         self.bot_token = self._get_env("BOT_TOKEN")
+        # Пул ботов: уведомления распределяются между всеми, каждый должен состоять в ALERT_CHAT_ID
+        self.bot_tokens = [self.bot_token] + [
+            token.strip() for token in os.getenv("BOT_EXTRA_TOKENS", "").split(",") if token.strip()
+        ]
+        # Адрес Bot API (для локального Bot API сервера или тестового стенда)
+        self.bot_api_url = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+        # Отчет о длительности фаз запуска (импорт, подключение, настройка каналов)
+        self.startup_profile = self._get_env_bool("STARTUP_PROFILE", False)
+        # Пул HTTP соединений с Bot API: размер, keep-alive (с) и таймаут чтения ответа (с)
+        self.bot_api_connections = self._get_env_int_optional("BOT_API_CONNECTIONS", 100)
+        self.bot_api_keepalive = self._get_env_int_optional("BOT_API_KEEPALIVE", 60)
+        self.bot_api_timeout = self._get_env_int_optional("BOT_API_TIMEOUT", 60)
         self.alert_chat_id = self._get_env_int("ALERT_CHAT_ID")
-        self.channels = self._parse_channels(self._get_env("CHANNELS"))
+        # Правила фильтрации и маршрутизации комментариев по чатам (JSON, опционально)
+        self.rules_file = os.getenv("RULES_FILE", "")
+        # Список каналов: из CHANNELS или из файла CHANNELS_FILE, который
+        # перечитывается на лету при изменении и по SIGHUP
+        self.channels_file = os.getenv("CHANNELS_FILE", "")
+        if self.channels_file:
+            try:
+                self.channels = self._parse_channels(self.read_channels_file(self.channels_file))
+            except OSError as e:
+                logger.error(f"Не удалось прочитать CHANNELS_FILE: {e}")
+                sys.exit(1)
+        else:
+            self.channels = self._parse_channels(self._get_env("CHANNELS"))
+        self.channels_reload_interval = self._get_env_int_optional("CHANNELS_RELOAD_INTERVAL", 5)
         self.timezone = os.getenv("TZ", "UTC")
+        # Очередь доставки и пул воркеров
+        self.delivery_workers = self._get_env_int_optional("DELIVERY_WORKERS", 4)
+        self.queue_max_size = self._get_env_int_optional("QUEUE_MAX_SIZE", 1000)
+        self.stats_interval = self._get_env_int_optional("STATS_INTERVAL", 60)
+        # Деградация под нагрузкой: отставание (с) от публикации комментария, при
+        # котором включаются уровни 1-3 (медиа текстом, однострочные уведомления,
+        # отброс каналов LOW_PRIORITY_CHANNELS). Пусто или 0 - отключено
+        self.shed_lag_thresholds = self._parse_shed_thresholds(
+            "SHED_LAG_SECONDS", os.getenv("SHED_LAG_SECONDS", "60,180,600")
+        )
+        self.shed_recovery = self._get_env_int_optional("SHED_RECOVERY_SECONDS", 30)
+        self.low_priority_channels = frozenset(
+            ChannelStore.key(ch) for ch in os.getenv("LOW_PRIORITY_CHANNELS", "").split(",") if ch.strip()
+        )
+        # Лимиты Bot API: сообщений в минуту на чат и в секунду суммарно
+        self.bot_chat_rate = self._get_env_int_optional("BOT_API_CHAT_RATE", 20)
+        self.bot_global_rate = self._get_env_int_optional("BOT_API_GLOBAL_RATE", 30)
+        # Кэш резолва поста в группе обсуждений -> пост в канале
+        self.post_cache_size = self._get_env_int_optional("POST_CACHE_SIZE", 10000)
+        self.post_cache_ttl = self._get_env_int_optional("POST_CACHE_TTL", 86400)
+        self.post_batch_delay_ms = self._get_env_int_optional("POST_BATCH_DELAY_MS", 20)
+        # Кэш данных авторов комментариев
+        self.sender_cache_size = self._get_env_int_optional("SENDER_CACHE_SIZE", 5000)
+        self.sender_cache_ttl = self._get_env_int_optional("SENDER_CACHE_TTL", 600)
+        # Режим передачи медиа: buffer - целиком в память, stream - потоково
+        self.media_relay_mode = os.getenv("MEDIA_RELAY_MODE", "buffer").strip().lower()
+        if self.media_relay_mode not in ("buffer", "stream"):
+            logger.error("MEDIA_RELAY_MODE должен быть buffer или stream")
+            sys.exit(1)
+        # В потоковом режиме память не зависит от размера файла, поэтому порог
+        # по умолчанию поднимается до лимита загрузки Bot API (50 МБ)
+        default_video_mb = 50 if self.media_relay_mode == "stream" else 10
+        self.video_max_size = self._get_env_int_optional("VIDEO_MAX_SIZE_MB", default_video_mb) * 1024 * 1024
+        self.stream_chunk_size = self._get_env_int_optional("STREAM_CHUNK_KB", 512) * 1024
+        # Сколько памяти могут одновременно занимать скачиваемые медиафайлы (0 - без
+        # ограничения) и сколько секунд ждать места, прежде чем отправить текстом
+        self.media_memory_limit = self._get_env_int_optional("MEDIA_MEMORY_MB", 100) * 1024 * 1024
+        self.media_memory_wait = self._get_env_int_optional("MEDIA_MEMORY_WAIT", 30)
+        # Политика медиа: до какого размера файл каждого типа скачивается целиком.
+        # Больше порога - только превью (если у файла есть миниатюра) или текст.
+        # Для остальных типов порог по умолчанию - лимит загрузки Bot API (50 МБ)
+        self.media_max_sizes = {
+            kind: 50 * 1024 * 1024 for kind in ("gif", "voice", "audio", "document")
+        }
+        self.media_max_sizes["video"] = self.video_max_size
+        self.media_max_sizes.update(self._parse_size_map("MEDIA_MAX_SIZE_MB", os.getenv("MEDIA_MAX_SIZE_MB", "")))
+        self.media_thumbnails = self._get_env_bool("MEDIA_THUMBNAILS", True)
+        # Доставка медиа: upload - скачать и загрузить в Bot API; reference - отправить
+        # файл по ссылке с user-сессии; forward - переслать оригинал и добавить заголовок
+        self.media_delivery = os.getenv("MEDIA_DELIVERY", "upload").strip().lower()
+        if self.media_delivery not in ("upload", "reference", "forward"):
+            logger.error("MEDIA_DELIVERY должен быть upload, reference или forward")
+            sys.exit(1)
+        # Сколько каналов настраивать параллельно при запуске
+        self.setup_concurrency = self._get_env_int_optional("SETUP_CONCURRENCY", 5)
+        # Режим дайджеста: склейка комментариев в меньшее число сообщений Bot API
+        self.digest_mode = self._get_env_bool("DIGEST_MODE")
+        self.digest_window = self._get_env_int_optional("DIGEST_WINDOW", 10)
+        self.digest_max_items = self._get_env_int_optional("DIGEST_MAX_ITEMS", 20)
+        # Durable outbox: уведомления переживают исчерпание ретраев и перезапуск
+        self.outbox_enabled = self._get_env_bool("OUTBOX_ENABLED", True)
+        self.outbox_commit_ms = self._get_env_int_optional("OUTBOX_COMMIT_MS", 10)
+        self.outbox_retry_interval = self._get_env_int_optional("OUTBOX_RETRY_INTERVAL", 60)
+        # Догрузка пропущенных комментариев после перезапуска и переподключения
+        self.catchup_enabled = self._get_env_bool("CATCHUP_ENABLED", True)
+        self.catchup_max_messages = self._get_env_int_optional("CATCHUP_MAX_MESSAGES", 1000)
+        self.catchup_concurrency = self._get_env_int_optional("CATCHUP_CONCURRENCY", 3)
+        # HTTP endpoint метрик в формате Prometheus (0 - отключен)
+        self.metrics_port = self._get_env_int_optional("METRICS_PORT", 0)
+        self.metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+        # Каталог для файлов состояния (кэши, переживающие перезапуск)
+        self.state_dir = os.getenv("STATE_DIR", "state")
+        # Запись входящих событий для воспроизведения через replay.py (пусто - отключено).
+        # В trace попадают тексты комментариев, если не включено TRACE_REDACT_TEXT
+        self.trace_file = os.getenv("TRACE_FILE", "")
+        self.trace_redact_text = self._get_env_bool("TRACE_REDACT_TEXT", False)
+        # Через сколько секунд перепроверять сохраненный резолв канала
+        self.channel_cache_ttl = self._get_env_int_optional("CHANNEL_CACHE_TTL", 86400)
+        # Кэш file_id Bot API для повторяющихся медиа (0 - отключить)
+        self.file_id_cache_size = self._get_env_int_optional("FILE_ID_CACHE_SIZE", 5000)
+        # Логирование: общий уровень, уровни по категориям, формат и выборка
+        self.log_level = self._parse_log_level("LOG_LEVEL", os.getenv("LOG_LEVEL", "INFO"))
+        self.log_categories = self._parse_log_categories(os.getenv("LOG_CATEGORIES", ""))
+        self.log_format = os.getenv("LOG_FORMAT", "text").strip().lower()
+        if self.log_format not in ("text", "json"):
+            logger.error("LOG_FORMAT должен быть text или json")
+            sys.exit(1)
+        self.log_sample_per_sec = self._get_env_int_optional("LOG_SAMPLE_PER_SEC", 10)
     
     @staticmethod
     def _get_env(key: str) -> str:
@@ -65,6 +373,94 @@ class Config:
             logger.error(f"Переменная окружения {key} должна быть числом")
             sys.exit(1)
     
+    @staticmethod
+    def _get_env_int_optional(key: str, default: int) -> int:
+        """Получить необязательную числовую переменную окружения"""
+        value = os.getenv(key)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            logger.error(f"Переменная окружения {key} должна быть числом")
+            sys.exit(1)
+    
+    @staticmethod
+    def _get_env_bool(key: str, default: bool = False) -> bool:
+        """Получить необязательный флаг из переменной окружения (1/true/yes/on)"""
+        value = os.getenv(key)
+        if not value:
+            return default
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    
+    @staticmethod
+    def _parse_size_map(key: str, value: str) -> Dict[str, int]:
+        """Парсинг порогов по типам медиа в мегабайтах: video=20,document=5"""
+        sizes = {}
+        for item in value.split(","):
+            if not item.strip():
+                continue
+            kind, _, size_mb = item.partition("=")
+            kind = kind.strip().lower()
+            if kind not in MediaInfo.KINDS:
+                logger.error(f"{key}: неизвестный тип медиа {kind} (доступны: {', '.join(MediaInfo.KINDS)})")
+                sys.exit(1)
+            try:
+                sizes[kind] = int(float(size_mb) * 1024 * 1024)
+            except ValueError:
+                logger.error(f"{key}: размер для {kind} должен быть числом")
+                sys.exit(1)
+        return sizes
+    
+    @staticmethod
+    def _parse_shed_thresholds(key: str, value: str) -> Tuple[float, ...]:
+        """Парсинг трех возрастающих порогов отставания в секундах: 60,180,600"""
+        if value.strip() in ("", "0"):
+            return ()
+        try:
+            thresholds = tuple(float(item) for item in value.split(","))
+        except ValueError:
+            logger.error(f"{key}: пороги должны быть числами через запятую")
+            sys.exit(1)
+        if len(thresholds) != 3 or list(thresholds) != sorted(thresholds) or thresholds[0] <= 0:
+            logger.error(f"{key}: нужно три возрастающих положительных порога, например 60,180,600")
+            sys.exit(1)
+        return thresholds
+    
+    @staticmethod
+    def _parse_log_level(key: str, value: str) -> int:
+        """Уровень логирования по имени (DEBUG, INFO, WARNING, ERROR)"""
+        level = logging.getLevelName(value.strip().upper())
+        if not isinstance(level, int):
+            logger.error(f"{key}: неизвестный уровень логирования {value}")
+            sys.exit(1)
+        return level
+    
+    @staticmethod
+    def _parse_log_categories(categories_str: str) -> Dict[str, int]:
+        """Парсинг уровней по категориям: event=DEBUG,media=WARNING"""
+        categories = {}
+        for item in categories_str.split(","):
+            if not item.strip():
+                continue
+            category, _, level = item.partition("=")
+            category = category.strip().lower()
+            if category not in LOG_CATEGORIES:
+                logger.error(
+                    f"LOG_CATEGORIES: неизвестная категория {category} "
+                    f"(доступны: {', '.join(LOG_CATEGORIES)})"
+                )
+                sys.exit(1)
+            categories[category] = Config._parse_log_level("LOG_CATEGORIES", level)
+        return categories
+    
+    @staticmethod
+    def read_channels_file(path: str) -> str:
+        """Читает файл каналов: через запятую или по одному на строку, # - комментарий"""
+        with open(path, encoding="utf-8") as f:
+            lines = [line.split("#", 1)[0] for line in f]
+        return ",".join(lines)
+    
     @staticmethod
     def _parse_channels(channels_str: str) -> list[str]:
         """Парсинг списка каналов из строки"""
@@ -75,179 +471,3007 @@ class Config:
         return channels
 
 
-class CommentMonitor:
-    """Основной класс мониторинга комментариев"""
+class Counter:
+    """Счетчик Prometheus с метками"""
     
-    def __init__(self, config: Config):
-        self.config = config
-        self.client = TelegramClient(
-            StringSession(config.string_session),
-            config.api_id,
-            config.api_hash
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, *labels: str, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+    
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками и фиксированными границами корзин"""
+    
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # метки -> (счетчики по корзинам без накопления, сумма, количество)
+        self.values: Dict[Tuple[str, ...], list] = {}
+    
+    def observe(self, value: float, *labels: str):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.values[labels] = entry
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+    
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                label_str = _format_labels(self.label_names + ("le",), labels + (le,))
+                lines.append(f"{self.name}_bucket{label_str} {cumulative}")
+            label_str = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metrics:
+    """Метрики монитора: латентность этапов, исходы доставки, байты и ретраи
+    
+    Обновление метрики - несколько операций со словарем, поэтому их можно
+    держать включенными постоянно. Gauge считаются только при запросе /metrics.
+    """
+    
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            "tgmon_stage_seconds",
+            "Длительность этапов обработки комментария",
+            ("stage",)
         )
-        # Маппинг: linked_chat_id -> (channel_username, channel_title)
-        self.linked_groups: Dict[int, Tuple[Optional[str], str]] = {}
-        # Список entity объектов групп для подписки на события
-        self.group_entities = []
-        self.http_session: Optional[aiohttp.ClientSession] = None
+        self.end_to_end_seconds = Histogram(
+            "tgmon_end_to_end_seconds",
+            "Время от message.date до успешного ответа Bot API",
+            buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+        )
+        self.comments = Counter("tgmon_comments_total", "Принятые комментарии по типу", ("type",))
+        self.notifications = Counter(
+            "tgmon_notifications_total", "Уведомления по исходу доставки", ("outcome",)
+        )
+        self.retries = Counter("tgmon_bot_api_retries_total", "Повторные попытки Bot API", ("method",))
+        self.bot_api_seconds = Histogram(
+            "tgmon_bot_api_seconds", "Латентность HTTP вызовов Bot API", ("method",)
+        )
+        self.bot_api_errors = Counter(
+            "tgmon_bot_api_errors_total", "Ошибки Bot API по методу и виду", ("method", "kind")
+        )
+        self.bytes = Counter("tgmon_bytes_total", "Переданные байты медиа", ("direction",))
+        self.media_tiers = Counter(
+            "tgmon_media_tier_total", "Решения политики медиа: full, thumb или text", ("type", "tier")
+        )
+        self.shed = Counter(
+            "tgmon_shed_total", "Комментарии, доставленные упрощенно или отброшенные под нагрузкой", ("action",)
+        )
+        self.gauges: Dict[str, Tuple[str, Any]] = {}
+    
+    def gauge(self, name: str, help_text: str, read):
+        """Регистрирует gauge, значение которого читается функцией read при запросе"""
+        self.gauges[name] = (help_text, read)
+    
+    def render(self) -> str:
+        lines = []
+        for metric in (
+            self.stage_seconds, self.end_to_end_seconds,
+            self.comments, self.notifications, self.retries, self.bytes, self.media_tiers,
+            self.bot_api_seconds, self.bot_api_errors, self.shed
+        ):
+            lines.extend(metric.render())
+        for name, (help_text, read) in self.gauges.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def load_json(path: str, default):
+    """Читает JSON-файл состояния; при отсутствии или повреждении возвращает default"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать {path}: {e}")
+        return default
+
+
+def save_json_atomic(path: str, data):
+    """Атомарно записывает JSON-файл состояния через временный файл"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class ChannelStore:
+    """Персистентный кэш резолва канал -> группа обсуждений
+    
+    Хранит ID и access_hash канала и группы, названия и факт вступления, чтобы
+    после перезапуска монитор поднимался сразу, без resolve/join/GetFullChannel.
+    """
+    
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.entries: Dict[str, dict] = load_json(path, {})
+    
+    @staticmethod
+    def key(channel_username: str) -> str:
+        return channel_username.lstrip("@").lower()
+    
+    def get(self, channel_username: str) -> Optional[dict]:
+        return self.entries.get(self.key(channel_username))
+    
+    def put(self, channel_username: str, entry: dict):
+        entry["validated_at"] = time.time()
+        self.entries[self.key(channel_username)] = entry
+    
+    def discard(self, channel_username: str):
+        self.entries.pop(self.key(channel_username), None)
+    
+    def is_stale(self, entry: dict) -> bool:
+        return time.time() - entry.get("validated_at", 0) > self.ttl
+    
+    def retain(self, channels: list[str]):
+        """Удаляет записи каналов, которых больше нет в конфигурации"""
+        keep = {self.key(ch) for ch in channels}
+        for key in list(self.entries):
+            if key not in keep:
+                del self.entries[key]
+    
+    async def save(self):
+        """Сохраняет кэш на диск"""
+        try:
+            await asyncio.to_thread(save_json_atomic, self.path, self.entries)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кэш каналов: {e}")
+
+
+class Outbox:
+    """Durable outbox уведомлений на SQLite (WAL)
+    
+    Каждое уведомление записывается до доставки и помечается доставленным после
+    успеха. Записи копятся и фиксируются одной транзакцией раз в commit_interval
+    (group commit), все обращения к базе идут в отдельном потоке. Ключ записи
+    обеспечивает идемпотентность: доставленное уведомление не отправляется повторно.
+    Уведомление, которое Bot API отверг неустранимой ошибкой, помечается
+    доставленным с флагом failed и больше не повторяется.
+    """
+    
+    # Сколько дней хранить доставленные записи
+    KEEP_DONE_DAYS = 7
+    
+    def __init__(self, path: str, commit_interval: float):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.db: Optional[sqlite3.Connection] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self.appends: list[Tuple[str, str, str, asyncio.Future]] = []
+        self.done_keys: list[str] = []
+        self.failed_keys: list[str] = []
+        # Ключи, которые сейчас доставляются в этом процессе
+        self.inflight: set[str] = set()
+        self.wakeup = asyncio.Event()
+        self.writer_task: Optional[asyncio.Task] = None
+        self.stats_appended = 0
+        self.stats_duplicates = 0
+        self.stats_commits = 0
+        self.stats_failed = 0
+    
+    async def start(self):
+        """Открывает базу и запускает фоновую фиксацию батчей"""
+        await self._run(self._open)
+        self.writer_task = asyncio.create_task(self._writer())
+    
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL synchronous=NORMAL не теряет данные при падении процесса
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " key TEXT PRIMARY KEY,"
+            " method TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " done INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(outbox)")}
+        if "failed" not in columns:
+            # База от версии без отметки неустранимых ошибок
+            self.db.execute("ALTER TABLE outbox ADD COLUMN failed INTEGER NOT NULL DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox(done, created_at)")
+        self.db.execute(
+            "DELETE FROM outbox WHERE done = 1 AND updated_at < ?",
+            (time.time() - self.KEEP_DONE_DAYS * 86400,)
+        )
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+    
+    async def append(self, key: str, method: str, payload: dict) -> bool:
+        """Записывает уведомление перед доставкой
+        
+        Возвращает True, если его нужно доставлять, и False, если оно уже
+        доставлено или прямо сейчас доставляется другой задачей.
+        """
+        if key in self.inflight:
+            self.stats_duplicates += 1
+            return False
+        self.inflight.add(key)
+        future = asyncio.get_running_loop().create_future()
+        self.appends.append((key, method, json.dumps(payload, ensure_ascii=False), future))
+        self.wakeup.set()
+        deliver = await future
+        if not deliver:
+            self.inflight.discard(key)
+            self.stats_duplicates += 1
+        return deliver
+    
+    def mark_done(self, key: str):
+        """Помечает уведомление доставленным (фиксируется со следующим батчем)"""
+        self.inflight.discard(key)
+        self.done_keys.append(key)
+        self.wakeup.set()
+    
+    def mark_failed(self, key: str):
+        """Bot API отверг уведомление неустранимой ошибкой: повторять его бессмысленно"""
+        self.inflight.discard(key)
+        self.failed_keys.append(key)
+        self.stats_failed += 1
+        self.wakeup.set()
+    
+    def release(self, key: str):
+        """Ретраи исчерпаны: запись остается в outbox для повторной попытки"""
+        self.inflight.discard(key)
+    
+    async def _writer(self):
+        """Фиксирует накопленные записи одной транзакцией"""
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.commit_interval)
+            await self._commit()
+    
+    async def _commit(self):
+        self.wakeup.clear()
+        appends, self.appends = self.appends, []
+        done_keys, self.done_keys = self.done_keys, []
+        failed_keys, self.failed_keys = self.failed_keys, []
+        if not appends and not done_keys and not failed_keys:
+            return
+        try:
+            results = await self._run(
+                self._commit_batch, [(k, m, p) for k, m, p, _ in appends], done_keys, failed_keys
+            )
+            self.stats_commits += 1
+        except Exception as e:
+            # Ошибка диска не должна останавливать доставку
+            logger.error(f"Ошибка записи в outbox: {e}")
+            results = [True] * len(appends)
+        for (_, _, _, future), deliver in zip(appends, results):
+            if not future.done():
+                future.set_result(deliver)
+        self.stats_appended += len(appends)
+    
+    def _commit_batch(
+        self, appends: list[Tuple[str, str, str]], done_keys: list[str], failed_keys: list[str]
+    ) -> list[bool]:
+        now = time.time()
+        results = []
+        self.db.execute("BEGIN")
+        try:
+            for key, method, payload in appends:
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO outbox (key, method, payload, done, created_at, updated_at) "
+                    "VALUES (?, ?, ?, 0, ?, ?)",
+                    (key, method, payload, now, now)
+                )
+                if cursor.rowcount:
+                    results.append(True)
+                else:
+                    row = self.db.execute("SELECT done FROM outbox WHERE key = ?", (key,)).fetchone()
+                    results.append(not row[0])
+            self.db.executemany(
+                "UPDATE outbox SET done = 1, updated_at = ? WHERE key = ?",
+                [(now, key) for key in done_keys]
+            )
+            self.db.executemany(
+                "UPDATE outbox SET done = 1, failed = 1, updated_at = ? WHERE key = ?",
+                [(now, key) for key in failed_keys]
+            )
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return results
+    
+    async def pending(self, older_than: float = 0.0) -> list[Tuple[str, str, dict]]:
+        """Недоставленные записи, которые сейчас никто не доставляет"""
+        rows = await self._run(self._select_pending, time.time() - older_than)
+        return [
+            (key, method, json.loads(payload))
+            for key, method, payload in rows
+            if key not in self.inflight
+        ]
+    
+    def _select_pending(self, created_before: float) -> list[Tuple[str, str, str]]:
+        return self.db.execute(
+            "SELECT key, method, payload FROM outbox WHERE done = 0 AND created_at <= ? "
+            "ORDER BY created_at",
+            (created_before,)
+        ).fetchall()
+    
+    def claim(self, key: str) -> bool:
+        """Берет запись в доставку при повторе; False - ее уже доставляют"""
+        if key in self.inflight:
+            return False
+        self.inflight.add(key)
+        return True
+    
+    async def close(self):
+        """Фиксирует остатки и закрывает базу"""
+        if self.writer_task:
+            self.writer_task.cancel()
+            await asyncio.gather(self.writer_task, return_exceptions=True)
+        if self.db is not None:
+            await self._commit()
+            await self._run(self.db.close)
+            self.db = None
+        self.executor.shutdown(wait=False)
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета"""
+        return (
+            f"записей {self.stats_appended}, дублей {self.stats_duplicates}, "
+            f"транзакций {self.stats_commits}, отклонено {self.stats_failed}, в доставке {len(self.inflight)}"
+        )
+
+
+class CheckpointStore:
+    """Персистентные ID последних обработанных сообщений по группам обсуждений
+    
+    Checkpoint группы - ID, до которого включительно все сообщения обработаны:
+    пока сообщение в очереди или у воркера, checkpoint за него не переходит,
+    даже если более новые сообщения уже обработаны. Пока группа догружается,
+    checkpoint не обгоняет позицию догрузки: live-сообщения новее нее не
+    должны перескакивать еще не полученный диапазон.
+    """
+    
+    SAVE_DELAY = 5
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.checkpoints: Dict[int, int] = {
+            int(chat_id): last_id for chat_id, last_id in load_json(path, {}).items()
+        }
+        # ID -> сколько раз сообщение удерживает checkpoint (воркер, дайджесты)
+        self.inflight: Dict[int, Dict[int, int]] = {}
+        self.max_seen: Dict[int, int] = {}
+        # Последний ID, полученный догрузкой группы, пока она идет
+        self.catch_up_positions: Dict[int, int] = {}
+        self.save_task: Optional[asyncio.Task] = None
+    
+    def get(self, chat_id: int) -> Optional[int]:
+        return self.checkpoints.get(chat_id)
+    
+    def started(self, chat_id: int, message_id: int):
+        """Сообщение принято в обработку (каждому started соответствует один finished)"""
+        inflight = self.inflight.setdefault(chat_id, {})
+        inflight[message_id] = inflight.get(message_id, 0) + 1
+        self.max_seen[chat_id] = max(self.max_seen.get(chat_id, 0), message_id)
+    
+    def finished(self, chat_id: int, message_id: int):
+        """Сообщение обработано (или отфильтровано)"""
+        inflight = self.inflight.get(chat_id, {})
+        if inflight.get(message_id, 0) > 1:
+            inflight[message_id] -= 1
+        else:
+            inflight.pop(message_id, None)
+        self.max_seen[chat_id] = max(self.max_seen.get(chat_id, 0), message_id)
+        self._advance(chat_id)
+    
+    def catch_up_started(self, chat_id: int, position: int):
+        """Догрузка группы началась с position; checkpoint удерживается на ней"""
+        self.catch_up_positions[chat_id] = position
+    
+    def catch_up_progress(self, chat_id: int, message_id: int):
+        """Догрузка получила все сообщения группы до message_id включительно"""
+        if chat_id in self.catch_up_positions:
+            self.catch_up_positions[chat_id] = message_id
+            self._advance(chat_id)
+    
+    def catch_up_finished(self, chat_id: int):
+        """Догрузка группы завершена, checkpoint снова следует за обработкой"""
+        if self.catch_up_positions.pop(chat_id, None) is not None and chat_id in self.max_seen:
+            self._advance(chat_id)
+    
+    def _advance(self, chat_id: int):
+        inflight = self.inflight.get(chat_id)
+        watermark = min(inflight) - 1 if inflight else self.max_seen.get(chat_id, 0)
+        if chat_id in self.catch_up_positions:
+            watermark = min(watermark, self.catch_up_positions[chat_id])
+        if watermark > self.checkpoints.get(chat_id, 0):
+            self.checkpoints[chat_id] = watermark
+            self._schedule_save()
+    
+    def discard(self, chat_id: int):
+        """Группа убрана из мониторинга: если ее вернут, она начнет с новых сообщений"""
+        self.checkpoints.pop(chat_id, None)
+        self.max_seen.pop(chat_id, None)
+        self.catch_up_positions.pop(chat_id, None)
+        self._schedule_save()
+    
+    def _schedule_save(self):
+        if self.save_task is None or self.save_task.done():
+            self.save_task = asyncio.create_task(self._delayed_save())
+    
+    async def _delayed_save(self):
+        await asyncio.sleep(self.SAVE_DELAY)
+        await self.save()
+    
+    async def save(self):
+        """Сохраняет checkpoint'ы на диск"""
+        data = {str(chat_id): last_id for chat_id, last_id in self.checkpoints.items()}
+        try:
+            await asyncio.to_thread(save_json_atomic, self.path, data)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить checkpoint'ы: {e}")
+
+
+class TraceRecorder:
+    """Запись входящих событий в trace-файл для офлайн-воспроизведения (replay.py)
+    
+    Событие - строка JSON с полями, которые читает конвейер: время получения и
+    публикации, чат, reply_to, автор, текст и параметры медиа без содержимого.
+    Строки копятся в памяти и дописываются в файл из отдельного потока раз в
+    FLUSH_INTERVAL, поэтому запись не блокирует event loop.
+    """
+    
+    FLUSH_INTERVAL = 1.0
+    
+    def __init__(self, path: str, redact_text: bool):
+        self.path = path
+        self.redact_text = redact_text
+        self.pending: list[str] = []
+        self.file = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self.stats_events = 0
+    
+    async def start(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.file = await asyncio.to_thread(open, self.path, "a", encoding="utf-8")
+        self.flush_task = asyncio.create_task(self._flush_periodically())
+    
+    def record(self, message, chat_id: int, channel_username: Optional[str]):
+        event = {"t": round(time.time(), 3), "d": int(message.date.timestamp()), "c": chat_id, "id": message.id}
+        reply_to = message.reply_to
+        if reply_to:
+            event["r"] = reply_to.reply_to_msg_id
+            if reply_to.reply_to_top_id:
+                event["top"] = reply_to.reply_to_top_id
+        if channel_username:
+            event["ch"] = channel_username
+        event["s"] = message.sender_id
+        # Автор берется только из сущностей апдейта, без запросов к Telegram
+        sender = getattr(message, "sender", None)
+        if sender is not None:
+            event["fn"] = getattr(sender, "first_name", None) or getattr(sender, "title", None)
+            event["un"] = getattr(sender, "username", None)
+        text = message.message or ""
+        if text:
+            event["x"] = "x" * len(text) if self.redact_text else text
+        if message.media:
+            info = classify_media(message.media)
+            event["k"] = info.kind
+            if info.size:
+                event["z"] = info.size
+            if info.mime_type:
+                event["mt"] = info.mime_type
+            if info.has_thumb:
+                event["th"] = 1
+            # ID файла нужен, чтобы при воспроизведении повторялись те же медиа (кэш file_id)
+            media_object = getattr(message.media, "photo", None) or getattr(message.media, "document", None)
+            if media_object is not None:
+                event["mid"] = media_object.id
+        self.pending.append(json.dumps(event, ensure_ascii=False, separators=(",", ":")))
+        self.stats_events += 1
+    
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            await self.flush()
+    
+    async def flush(self):
+        lines, self.pending = self.pending, []
+        if lines:
+            try:
+                await asyncio.to_thread(self._write, lines)
+            except OSError as e:
+                logger.warning(f"Не удалось записать trace: {e}")
+    
+    def _write(self, lines: list[str]):
+        self.file.write("\n".join(lines) + "\n")
+        self.file.flush()
+    
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+        if self.file:
+            await self.flush()
+            self.file.close()
+
+
+class FloodWaitActive(Exception):
+    """Запрос не отправлен: сессия на паузе FloodWait дольше допустимого ожидания"""
+
+
+class FloodWaitLimiter:
+    """Общий ограничитель запросов MTProto
+    
+    Если любой запрос получил FloodWaitError, все задачи, идущие через
+    ограничитель, ждут окончания FloodWait, а сам запрос повторяется.
+    Запросы горячего пути (резолв поста, скачивание медиа) ждут не дольше
+    HOT_PATH_MAX_WAIT: при долгом FloodWait комментарий уходит в упрощенном
+    виде, а каналы сессии переезжают на другие аккаунты.
+    """
+    
+    HOT_PATH_MAX_WAIT = 30
+    
+    def __init__(self, max_retries: int = 3, on_flood: Optional[Callable[[int], None]] = None):
+        self.max_retries = max_retries
+        # Вызывается с длительностью каждого FloodWait (для ребалансировки сессий)
+        self.on_flood = on_flood
+        self.resume_at = 0.0
+        self.flood_waits = 0
+        self.flood_wait_total = 0
+    
+    async def wait(self, max_wait: Optional[float] = None):
+        """Ждет окончания текущего FloodWait, если он есть
+        
+        Если до конца FloodWait дольше max_wait, сразу бросает FloodWaitActive.
+        """
+        while True:
+            pause = self.resume_at - time.monotonic()
+            if pause <= 0:
+                return
+            if max_wait is not None and pause > max_wait:
+                raise FloodWaitActive(f"сессия на паузе FloodWait еще {pause:.0f} с")
+            await asyncio.sleep(pause)
+    
+    async def call(self, make_request, what: str, max_wait: Optional[float] = None):
+        """Выполняет запрос (make_request возвращает корутину) с учетом FloodWait"""
+        for attempt in range(1, self.max_retries + 1):
+            await self.wait(max_wait)
+            try:
+                return await make_request()
+            except FloodWaitError as e:
+                self.register(e, f"{what} (попытка {attempt}/{self.max_retries})")
+                if attempt == self.max_retries or (max_wait is not None and e.seconds > max_wait):
+                    raise
+    
+    def register(self, error: FloodWaitError, what: str):
+        """Учитывает FloodWait: все запросы через ограничитель ждут его окончания"""
+        self.flood_waits += 1
+        self.flood_wait_total += error.seconds
+        self.resume_at = max(self.resume_at, time.monotonic() + error.seconds)
+        logger.warning(f"FloodWait {error.seconds} с при запросе {what}, все запросы приостановлены")
+        if self.on_flood:
+            self.on_flood(error.seconds)
+
+
+class ConsistentHashRing:
+    """Консистентное хеширование каналов по сессиям
+    
+    Каждая сессия занимает REPLICAS виртуальных точек на кольце. При удалении
+    или добавлении сессии переезжают только каналы, попавшие на ее точки.
+    """
+    
+    REPLICAS = 100
+    
+    def __init__(self):
+        self.points: list[int] = []
+        self.owners: Dict[int, str] = {}
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+    
+    def add(self, node: str):
+        for replica in range(self.REPLICAS):
+            point = self._hash(f"{node}#{replica}")
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+                self.owners[point] = node
+    
+    def remove(self, node: str):
+        self.points = [point for point in self.points if self.owners[point] != node]
+        self.owners = {point: owner for point, owner in self.owners.items() if owner != node}
+    
+    def __len__(self) -> int:
+        return len(set(self.owners.values()))
+    
+    def node_for(self, key: str) -> Optional[str]:
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+class MonitorClient(TelegramClient):
+    """TelegramClient, сообщающий о каждом автоматическом переподключении
+    
+    Telethon вызывает _handle_auto_reconnect после восстановления соединения;
+    событие reconnected позволяет догрузить пропущенное даже после разрыва в
+    доли секунды, который не заметить опросом is_connected().
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reconnected = asyncio.Event()
+    
+    async def _handle_auto_reconnect(self):
+        await super()._handle_auto_reconnect()
+        self.reconnected.set()
+
+
+class SessionShard:
+    """Аккаунт из пула сессий: свой клиент, ограничитель FloodWait и подписка на события"""
+    
+    def __init__(self, index: int, client: TelegramClient):
+        self.index = index
+        self.client = client
+        # До подключения - номер в конфигурации, после - ID аккаунта (не зависит от порядка сессий)
+        self.name = f"#{index}"
+        self.flood_limiter = FloodWaitLimiter()
+        # Доступна ли сессия для новых каналов (нет - долгий FloodWait или отключение)
+        self.available = True
+
+
+class TokenBucket:
+    """Token bucket с резервированием: токены могут уходить в минус, задавая очередь ожидания"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self) -> float:
+        """Резервирует один токен и возвращает, сколько секунд нужно подождать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+    
+    def deficit(self) -> float:
+        """Сколько пришлось бы ждать токен сейчас, без резервирования"""
+        tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return max(0.0, (1 - tokens) / self.rate)
+
+
+class BotApiScheduler:
+    """Центральный планировщик исходящих вызовов Bot API
+    
+    Распределяет отправки так, чтобы не превышать глобальный лимит и лимит
+    на чат, и приостанавливает отправку в чат ровно на retry_after после 429.
+    """
+    
+    # Небольшой запас на всплеск для одного чата
+    CHAT_BURST = 3
+    
+    def __init__(self, global_rate: int, chat_rate_per_minute: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate_per_minute / 60
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until: Dict[int, float] = {}
+        # Статистика ожидания
+        self.stats_calls = 0
+        self.stats_delayed = 0
+        self.stats_wait_total = 0.0
+        self.stats_wait_max = 0.0
+        self.stats_rate_limited = 0
+    
+    async def acquire(self, chat_id: int) -> float:
+        """Ждет разрешения на вызов Bot API для чата, возвращает время ожидания"""
+        started = time.monotonic()
+        await self._wait_pause(chat_id)
+        
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        delay = max(self.global_bucket.reserve(), bucket.reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Пока ждали токен, мог прийти 429
+        await self._wait_pause(chat_id)
+        
+        waited = time.monotonic() - started
+        self.stats_calls += 1
+        if waited > 0.01:
+            self.stats_delayed += 1
+            self.stats_wait_total += waited
+            self.stats_wait_max = max(self.stats_wait_max, waited)
+        return waited
+    
+    async def _wait_pause(self, chat_id: int):
+        """Ждет окончания паузы после 429 для чата"""
+        while True:
+            pause = self.paused_until.get(chat_id, 0.0) - time.monotonic()
+            if pause <= 0:
+                return
+            await asyncio.sleep(pause)
+    
+    def estimate(self, chat_id: int) -> float:
+        """Ожидание вызова для чата, если начать его сейчас (с учетом паузы после 429)"""
+        pause = self.paused_until.get(chat_id, 0.0) - time.monotonic()
+        bucket = self.chat_buckets.get(chat_id)
+        return max(pause, self.global_bucket.deficit(), bucket.deficit() if bucket else 0.0)
+    
+    def pause(self, chat_id: int, retry_after: float):
+        """Приостанавливает отправку в чат на retry_after секунд"""
+        self.stats_rate_limited += 1
+        resume_at = time.monotonic() + retry_after
+        self.paused_until[chat_id] = max(self.paused_until.get(chat_id, 0.0), resume_at)
+    
+    def report(self) -> str:
+        """Краткая сводка ожидания для периодического отчета"""
+        avg = self.stats_wait_total / self.stats_delayed if self.stats_delayed else 0.0
+        return (
+            f"вызовов {self.stats_calls}, ждали {self.stats_delayed} "
+            f"(среднее {avg:.2f} с, макс {self.stats_wait_max:.2f} с), 429: {self.stats_rate_limited}"
+        )
+
+
+class BotSlot:
+    """Бот из пула: токен и собственный планировщик лимитов (лимиты Bot API - на бота)"""
+    
+    def __init__(self, token: str, global_rate: int, chat_rate_per_minute: int):
+        self.token = token
+        self.id = token.split(":", 1)[0]
+        self.scheduler = BotApiScheduler(global_rate, chat_rate_per_minute)
+
+
+class BotPool:
+    """Пул ботов для исходящих уведомлений
+    
+    Каждый вызов уходит через бота, которому меньше всего ждать лимита для
+    чата. Бот на паузе после 429 пропускается, пока есть свободные.
+    """
+    
+    def __init__(self, tokens: list[str], global_rate: int, chat_rate_per_minute: int):
+        self.bots = [BotSlot(token, global_rate, chat_rate_per_minute) for token in tokens]
+    
+    def select(self, chat_id: int) -> BotSlot:
+        return min(self.bots, key=lambda bot: bot.scheduler.estimate(chat_id))
+    
+    def report(self) -> str:
+        """Краткая сводка по ботам для периодического отчета"""
+        if len(self.bots) == 1:
+            return self.bots[0].scheduler.report()
+        return "; ".join(f"бот {bot.id}: {bot.scheduler.report()}" for bot in self.bots)
+
+
+class BotApiError(Exception):
+    """Неуспешный вызов Bot API
+    
+    kind определяет реакцию: retry_after - ждать указанное Telegram время,
+    retryable - повторить с backoff (5xx, сеть, таймаут), fatal - не повторять
+    (неверный запрос, бот не в чате, неверный токен: повтор даст тот же ответ).
+    """
+    
+    FATAL_STATUSES = frozenset({400, 401, 403, 404})
+    # Фрагменты описания 400, означающие, что отправленный file_id недействителен
+    INVALID_FILE_MARKERS = ("wrong file identifier", "wrong remote file", "file reference", "wrong type of the file")
+    
+    def __init__(self, method: str, status: int, description: str, retry_after: Optional[float] = None):
+        super().__init__(f"{method}: {status} {description}" if status else f"{method}: {description}")
+        self.method = method
+        self.status = status
+        self.description = description
+        self.retry_after = retry_after
+    
+    @property
+    def kind(self) -> str:
+        if self.retry_after is not None:
+            return "retry_after"
+        if self.status in self.FATAL_STATUSES:
+            return "fatal"
+        return "retryable"
+    
+    @property
+    def invalid_file(self) -> bool:
+        """Bot API не принимает file_id: его нужно забыть и загрузить файл заново"""
+        description = self.description.lower()
+        return self.status == 400 and any(marker in description for marker in self.INVALID_FILE_MARKERS)
+    
+    @classmethod
+    def from_response(cls, method: str, status: int, body: str) -> "BotApiError":
+        """Разбирает тело ответа с ошибкой: description и parameters.retry_after"""
+        description, retry_after = body, None
+        try:
+            data = json.loads(body)
+            description = data.get('description', body)
+            if status == 429:
+                retry_after = float(data['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            pass
+        return cls(method, status, description, retry_after)
+
+
+class BotApiClient:
+    """HTTP клиент Bot API с пулом keep-alive соединений
+    
+    Одна сессия на все боты: соединения с api.telegram.org переиспользуются,
+    DNS кэшируется, URL методов собираются один раз на (бот, метод). Ответ
+    либо возвращается как result, либо превращается в BotApiError. По каждому
+    методу копится статистика латентности для отчета и /metrics.
+    """
+    
+    JSON_HEADERS = {"Content-Type": "application/json"}
+    
+    def __init__(self, base_url: str, connection_limit: int, keepalive: float, timeout: float):
+        self.base_url = base_url
+        self.connection_limit = connection_limit
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.urls: Dict[Tuple[str, str], str] = {}
+        # метод -> [вызовов, ошибок, суммарная латентность, максимальная латентность]
+        self.stats: Dict[str, list] = {}
+    
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            ttl_dns_cache=300,
+            keepalive_timeout=self.keepalive,
+            enable_cleanup_closed=True
+        )
+        # total не ограничиваем: загрузка большого файла законно идет долго,
+        # зато зависшее соединение отсекается по connect и sock_read
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, connect=10, sock_read=self.timeout)
+        )
+    
+    async def close(self):
+        if self.session:
+            await self.session.close()
+    
+    def url(self, token: str, method: str) -> str:
+        key = (token, method)
+        url = self.urls.get(key)
+        if url is None:
+            url = f"{self.base_url}/bot{token}/{method}"
+            self.urls[key] = url
+        return url
+    
+    @classmethod
+    def json_request(cls, payload: dict) -> dict:
+        """kwargs запроса с JSON, сериализованным один раз на все попытки"""
+        return {'data': json.dumps(payload, ensure_ascii=False).encode(), 'headers': cls.JSON_HEADERS}
+    
+    async def call(self, token: str, method: str, request: dict) -> dict:
+        """Выполняет вызов; возвращает result ответа или бросает BotApiError"""
+        started = time.monotonic()
+        try:
+            async with self.session.post(self.url(token, method), **request) as response:
+                if response.status == 200:
+                    try:
+                        data = await response.json(content_type=None)
+                    except ValueError:
+                        data = None
+                    if isinstance(data, dict):
+                        self._record(method, time.monotonic() - started, None)
+                        return data.get('result') or {}
+                    # Страница прокси или обрезанный ответ: повтор может пройти
+                    error = BotApiError(method, response.status, "ответ не в формате JSON Bot API")
+                else:
+                    error = BotApiError.from_response(method, response.status, await response.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = BotApiError(method, 0, str(e) or type(e).__name__)
+        self._record(method, time.monotonic() - started, error)
+        raise error
+    
+    def _record(self, method: str, elapsed: float, error: Optional[BotApiError]):
+        entry = self.stats.get(method)
+        if entry is None:
+            entry = [0, 0, 0.0, 0.0]
+            self.stats[method] = entry
+        entry[0] += 1
+        entry[2] += elapsed
+        entry[3] = max(entry[3], elapsed)
+        metrics.bot_api_seconds.observe(elapsed, method)
+        if error:
+            entry[1] += 1
+            metrics.bot_api_errors.inc(method, error.kind)
+    
+    def report(self) -> str:
+        """Сводка по методам для периодического отчета; статистика сбрасывается"""
+        parts = [
+            f"{method} {count} (ср. {total / count * 1000:.0f} мс, макс. {peak * 1000:.0f} мс, ошибок {errors})"
+            for method, (count, errors, total, peak) in self.stats.items()
+        ]
+        self.stats.clear()
+        return ", ".join(parts) or "нет вызовов"
+
+
+class PostResolver:
+    """Резолв поста в группе обсуждений в ID поста канала с кэшированием
+    
+    LRU-кэш с TTL по ключу (chat_id, discussion_post_id). Параллельные запросы
+    одного ключа объединяются в один, а ID, ожидающие резолва в одной группе,
+    запрашиваются одним вызовом get_messages(ids=[...]).
+    """
+    
+    def __init__(
+        self,
+        shard_for: Callable[[int], "SessionShard"],
+        input_peers: Dict[int, InputPeerChannel],
+        max_size: int,
+        ttl: float,
+        batch_delay: float
+    ):
+        # Сессия, которая отвечает за группу (при шардировании аккаунтов)
+        self.shard_for = shard_for
+        self.input_peers = input_peers
+        self.max_size = max_size
+        self.ttl = ttl
+        self.batch_delay = batch_delay
+        # (chat_id, discussion_post_id) -> (channel_post_id или None, expires_at)
+        self.cache: OrderedDict[Tuple[int, int], Tuple[Optional[int], float]] = OrderedDict()
+        self.inflight: Dict[Tuple[int, int], asyncio.Future] = {}
+        self.pending: Dict[int, set[int]] = {}
+        self.flush_tasks: Dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+    
+    async def resolve(self, chat_id: int, discussion_post_id: int) -> Optional[int]:
+        """Возвращает ID поста в канале или None, если его не удалось определить"""
+        key = (chat_id, discussion_post_id)
+        cached = self.cache.get(key)
+        if cached and cached[1] > time.monotonic():
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+        
+        self.misses += 1
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.inflight[key] = future
+            self.pending.setdefault(chat_id, set()).add(discussion_post_id)
+            if chat_id not in self.flush_tasks:
+                self.flush_tasks[chat_id] = asyncio.create_task(self._flush(chat_id))
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(future)
+    
+    async def _flush(self, chat_id: int):
+        """Отправляет накопленные ID группы одним запросом get_messages"""
+        await asyncio.sleep(self.batch_delay)
+        self.flush_tasks.pop(chat_id, None)
+        post_ids = sorted(self.pending.pop(chat_id, ()))
+        if not post_ids:
+            return
+        
+        self.batches += 1
+        try:
+            peer = self.input_peers.get(chat_id, chat_id)
+            shard = self.shard_for(chat_id)
+            messages = await shard.flood_limiter.call(
+                lambda: shard.client.get_messages(peer, ids=post_ids),
+                "get_messages",
+                FloodWaitLimiter.HOT_PATH_MAX_WAIT
+            )
+        except Exception as e:
+            logger.error(f"   ❌ Ошибка при получении оригинальных сообщений {post_ids}: {e}")
+            messages = [None] * len(post_ids)
+        
+        for post_id, original_message in zip(post_ids, messages):
+            channel_post_id = self._extract_channel_post_id(original_message)
+            if original_message is not None:
+                self._store((chat_id, post_id), channel_post_id)
+            future = self.inflight.pop((chat_id, post_id), None)
+            if future and not future.done():
+                future.set_result(channel_post_id)
+    
+    @staticmethod
+    def _extract_channel_post_id(original_message) -> Optional[int]:
+        """Извлекает ID оригинального поста канала из пересланного сообщения"""
+        if not original_message or not original_message.fwd_from:
+            return None
+        fwd_from = original_message.fwd_from
+        if getattr(fwd_from, 'channel_post', None):
+            return fwd_from.channel_post
+        if getattr(fwd_from, 'saved_from_msg_id', None):
+            return fwd_from.saved_from_msg_id
+        return None
+    
+    def _store(self, key: Tuple[int, int], channel_post_id: Optional[int]):
+        """Кладет результат в кэш, вытесняя самые старые записи"""
+        self.cache[key] = (channel_post_id, time.monotonic() + self.ttl)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета"""
+        return (
+            f"попаданий {self.hits}, промахов {self.misses}, "
+            f"запросов get_messages {self.batches}, размер {len(self.cache)}"
+        )
+
+
+@dataclass
+class SenderInfo:
+    """Отображаемые данные автора комментария"""
+    name: str
+    username: str
+    id: int
+    expires_at: float = 0.0
+
+
+class SenderCache:
+    """Кэш данных авторов по user id с ограничением размера и TTL
+    
+    Заполняется из entity, которые уже пришли вместе с апдейтом. Устаревшая
+    запись отдается сразу, а обновляется в фоне, так что get_sender ждет
+    только самый первый комментарий нового автора.
+    """
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache: OrderedDict[int, SenderInfo] = OrderedDict()
+        self.refreshing: set[int] = set()
+        # Ссылки на фоновые обновления: event loop держит задачи только слабо
+        self.refresh_tasks: set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.from_update = 0
+        self.refreshes = 0
+    
+    async def get(self, message) -> SenderInfo:
+        """Возвращает данные автора сообщения, по возможности без сетевых запросов"""
+        sender_id = message.sender_id
+        
+        # Entity автора уже есть в апдейте - сеть не нужна
+        if message.sender is not None:
+            self.from_update += 1
+            return self._store(message.sender)
+        
+        cached = self.cache.get(sender_id) if sender_id is not None else None
+        if cached is not None:
+            self.hits += 1
+            self.cache.move_to_end(sender_id)
+            if cached.expires_at <= time.monotonic() and sender_id not in self.refreshing:
+                self.refreshing.add(sender_id)
+                task = asyncio.create_task(self._refresh(message, sender_id))
+                self.refresh_tasks.add(task)
+                task.add_done_callback(self.refresh_tasks.discard)
+            return cached
+        
+        self.misses += 1
+        sender = await message.get_sender()
+        if sender is None:
+            return SenderInfo("Неизвестный", "", sender_id or 0)
+        return self._store(sender)
+    
+    async def _refresh(self, message, sender_id: int):
+        """Фоновое обновление устаревшей записи"""
+        try:
+            sender = await message.get_sender()
+            if sender is not None:
+                self.refreshes += 1
+                self._store(sender)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить данные автора {sender_id}: {e}")
+        finally:
+            self.refreshing.discard(sender_id)
+    
+    def _store(self, sender) -> SenderInfo:
+        """Формирует отображаемые данные из entity и кладет их в кэш"""
+        # У пользователей есть имя и фамилия, у каналов (анонимные админы) - title
+        author_first = getattr(sender, 'first_name', None) or getattr(sender, 'title', None) or ""
+        author_last = getattr(sender, 'last_name', None) or ""
+        username = getattr(sender, 'username', None)
+        info = SenderInfo(
+            name=f"{author_first} {author_last}".strip() or "Неизвестный",
+            username=f"@{username}" if username else "",
+            id=sender.id,
+            expires_at=time.monotonic() + self.ttl,
+        )
+        self.cache[sender.id] = info
+        self.cache.move_to_end(sender.id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return info
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета"""
+        return (
+            f"из апдейта {self.from_update}, попаданий {self.hits}, промахов {self.misses}, "
+            f"фоновых обновлений {self.refreshes}, размер {len(self.cache)}"
+        )
+
+
+@dataclass
+class MediaInfo:
+    """Тип и параметры медиа сообщения, собранные за один проход по атрибутам"""
+    
+    KINDS = ("photo", "video", "sticker", "gif", "voice", "audio", "document", "other")
+    
+    kind: str
+    mime_type: str = ""
+    size: int = 0
+    filename: Optional[str] = None
+    has_thumb: bool = False
+
+
+def largest_variant_size(variants) -> int:
+    """Размер самого крупного варианта фото или миниатюры (у прогрессивных - список размеров)"""
+    return max(
+        (getattr(variant, "size", 0) or max(getattr(variant, "sizes", None) or [0]) for variant in variants or ()),
+        default=0
+    )
+
+
+def media_byte_size(media) -> int:
+    """Размер файла медиа в байтах, известный до скачивания"""
+    if isinstance(media, MessageMediaPhoto):
+        return largest_variant_size(media.photo.sizes) if media.photo else 0
+    if isinstance(media, MessageMediaDocument) and media.document:
+        return getattr(media.document, 'size', 0) or 0
+    return 0
+
+
+def classify_media(media) -> MediaInfo:
+    """Определяет тип медиа: photo, video, sticker, gif, voice, audio, document или other"""
+    if isinstance(media, MessageMediaPhoto):
+        return MediaInfo("photo", size=media_byte_size(media))
+    if not isinstance(media, MessageMediaDocument) or not media.document:
+        return MediaInfo("other")
+    
+    doc = media.document
+    mime_type = getattr(doc, 'mime_type', '') or ''
+    is_video = 'video' in mime_type
+    is_sticker = is_animated = is_audio = is_voice = False
+    filename = None
+    for attr in doc.attributes:
+        if isinstance(attr, DocumentAttributeVideo):
+            is_video = True
+        elif isinstance(attr, DocumentAttributeSticker):
+            is_sticker = True
+        elif isinstance(attr, DocumentAttributeAnimated):
+            is_animated = True
+        elif isinstance(attr, DocumentAttributeAudio):
+            is_audio = True
+            is_voice = bool(attr.voice)
+        elif isinstance(attr, DocumentAttributeFilename):
+            filename = attr.file_name
+    
+    # Порядок проверок повторяет приоритет типов при отправке
+    if is_video:
+        kind = "video"
+    elif is_sticker:
+        kind = "sticker"
+    elif is_animated or 'gif' in mime_type:
+        kind = "gif"
+    elif is_audio or 'audio' in mime_type:
+        kind = "voice" if is_voice else "audio"
+    else:
+        kind = "document"
+    return MediaInfo(
+        kind=kind,
+        mime_type=mime_type,
+        size=getattr(doc, 'size', 0) or 0,
+        filename=filename,
+        has_thumb=bool(doc.thumbs),
+    )
+
+
+class MediaPolicy:
+    """Выбор уровня доставки медиа по типу и размеру
+    
+    full - файл скачивается и отправляется целиком; thumb - скачивается только
+    миниатюра Telegram и уходит как фото-превью; text - текстовое уведомление.
+    """
+    
+    FULL = "full"
+    THUMB = "thumb"
+    TEXT = "text"
+    
+    def __init__(self, max_sizes: Dict[str, int], thumbnails: bool):
+        self.max_sizes = max_sizes
+        self.thumbnails = thumbnails
+    
+    def decide(self, info: MediaInfo) -> str:
+        max_size = self.max_sizes.get(info.kind)
+        if max_size is None or info.size <= max_size:
+            return self.FULL
+        if self.thumbnails and info.has_thumb:
+            return self.THUMB
+        return self.TEXT
+
+
+class MemoryBudget:
+    """Байтовый семафор: ограничивает суммарный размер медиа в памяти
+    
+    Размер файла известен до скачивания, поэтому место резервируется заранее.
+    Ожидающие обслуживаются по очереди, чтобы крупный файл не голодал за
+    потоком мелких; файл больше всего бюджета ждет, пока память освободится
+    целиком. Если место не освободилось за timeout, acquire возвращает False и
+    вызывающий выбирает деградированный путь. Лимит 0 - без ограничения.
+    """
+    
+    def __init__(self, limit: int, timeout: float):
+        self.limit = limit
+        self.timeout = timeout
+        self.used = 0
+        self.peak = 0
+        self.waiters: deque[Tuple[int, asyncio.Future]] = deque()
+        self.stats_waits = 0
+        self.stats_denied = 0
+    
+    def _weight(self, size: int) -> int:
+        return min(size, self.limit)
+    
+    def _grant(self, weight: int):
+        self.used += weight
+        self.peak = max(self.peak, self.used)
+    
+    def _wake(self):
+        while self.waiters:
+            weight, future = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+            elif self.used + weight <= self.limit:
+                self.waiters.popleft()
+                self._grant(weight)
+                future.set_result(None)
+            else:
+                break
+    
+    async def acquire(self, size: int) -> bool:
+        """Резервирует size байт; False - бюджет не освободился за timeout"""
+        if self.limit <= 0:
+            return True
+        weight = self._weight(size)
+        if not self.waiters and self.used + weight <= self.limit:
+            self._grant(weight)
+            return True
+        
+        self.stats_waits += 1
+        future = asyncio.get_running_loop().create_future()
+        entry = (weight, future)
+        self.waiters.append(entry)
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(size)
+            raise
+        finally:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+            # Ушедший из головы очереди мог блокировать тех, кто за ним
+            self._wake()
+        if future.done() and not future.cancelled():
+            return True
+        self.stats_denied += 1
+        return False
+    
+    def release(self, size: int):
+        if self.limit <= 0:
+            return
+        self.used -= self._weight(size)
+        self._wake()
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета; пик сбрасывается"""
+        report = (
+            f"занято {self.used / 1048576:.1f} из {self.limit / 1048576:.0f} МБ, "
+            f"пик {self.peak / 1048576:.1f} МБ, ожиданий {self.stats_waits}, отказов {self.stats_denied}"
+        )
+        self.peak = self.used
+        return report
+
+
+class BufferedMedia:
+    """Медиафайл, целиком скачанный в память"""
+    
+    # Аргументы download_media (у миниатюры - thumb)
+    DOWNLOAD_ARGS: Dict[str, Any] = {}
+    
+    def __init__(self, message, flood_limiter: FloodWaitLimiter):
+        self.message = message
+        # Ограничитель сессии, получившей сообщение: скачивание идет через нее
+        self.flood_limiter = flood_limiter
+        self.buffer: Optional[BytesIO] = None
+    
+    async def open(self):
+        """Скачивает файл в память"""
+        started = time.monotonic()
+        await self.flood_limiter.call(self._download, "download_media", FloodWaitLimiter.HOT_PATH_MAX_WAIT)
+        metrics.stage_seconds.observe(time.monotonic() - started, "download")
+        metrics.bytes.inc("downloaded", value=self.size)
+    
+    async def _download(self):
+        # Повтор после FloodWait начинает скачивание заново
+        self.buffer = BytesIO()
+        await self.message.download_media(file=self.buffer, **self.DOWNLOAD_ARGS)
+    
+    @property
+    def size(self) -> int:
+        return self.buffer.getbuffer().nbytes if self.buffer is not None else 0
+    
+    def payload(self):
+        """Тело файла для multipart; memoryview не копирует буфер"""
+        return self.buffer.getbuffer()
+    
+    def close(self):
+        self.buffer = None
+
+
+class ThumbnailMedia(BufferedMedia):
+    """Самая крупная миниатюра документа вместо самого файла (десятки КБ)"""
+    
+    DOWNLOAD_ARGS = {"thumb": -1}
+
+
+class StreamingMedia:
+    """Потоковая передача медиа из Telegram в Bot API
+    
+    Чанки iter_download сразу уходят в тело multipart-запроса, поэтому в памяти
+    одновременно находится не больше пары чанков. Параллельно данные пишутся во
+    временный файл на диске: из него читают повторные попытки отправки.
+    """
+    
+    # Размер чанка при повторной отправке из временного файла
+    SPILL_READ_SIZE = 256 * 1024
+    
+    def __init__(self, message, chunk_size: int, flood_limiter: FloodWaitLimiter):
+        self.message = message
+        self.chunk_size = chunk_size
+        self.flood_limiter = flood_limiter
+        self.spill = None
+        self.complete = False
+        self.bytes_downloaded = 0
+        self._stream = None
+    
+    async def open(self):
+        """Готовит временный файл; скачивание начнется вместе с отправкой"""
+        self.spill = tempfile.TemporaryFile(prefix="tgmon-")
+    
+    def payload(self):
+        """Тело файла для очередной попытки отправки"""
+        if self._stream is None and not self.complete:
+            # Первая попытка: качаем и отправляем одновременно
+            self._stream = self._relay()
+            return self._stream
+        return self._replay()
+    
+    async def _download(self):
+        """Чанки файла из Telegram; FloodWait учитывается ограничителем сессии"""
+        await self.flood_limiter.wait(FloodWaitLimiter.HOT_PATH_MAX_WAIT)
+        started = time.monotonic()
+        try:
+            async for chunk in self.message.client.iter_download(
+                self.message.media, chunk_size=self.chunk_size
+            ):
+                yield chunk
+        except FloodWaitError as e:
+            # Генератор нельзя повторить с середины: повтор сделает следующая попытка отправки
+            self.flood_limiter.register(e, "iter_download")
+            raise
+        # При потоковой передаче скачивание идет вместе с отправкой, поэтому время
+        # стадии считается до последнего чанка и включает ожидание Bot API
+        metrics.stage_seconds.observe(time.monotonic() - started, "download")
+    
+    async def _relay(self):
+        """Отдает чанки из Telegram, параллельно сохраняя их во временный файл"""
+        async for chunk in self._download():
+            await asyncio.to_thread(self.spill.write, chunk)
+            self.bytes_downloaded += len(chunk)
+            metrics.bytes.inc("downloaded", value=len(chunk))
+            yield chunk
+        self.complete = True
+    
+    async def _replay(self):
+        """Отдает файл из временного файла; докачивает его, если первая попытка оборвалась"""
+        if not self.complete:
+            await self._finish_download()
+        await asyncio.to_thread(self.spill.seek, 0)
+        while True:
+            chunk = await asyncio.to_thread(self.spill.read, self.SPILL_READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    
+    async def _finish_download(self):
+        """Скачивает файл заново целиком во временный файл"""
+        if self._stream is not None:
+            await self._stream.aclose()
+        self.spill.seek(0)
+        self.spill.truncate()
+        self.bytes_downloaded = 0
+        async for chunk in self._download():
+            await asyncio.to_thread(self.spill.write, chunk)
+            self.bytes_downloaded += len(chunk)
+            metrics.bytes.inc("downloaded", value=len(chunk))
+        self.complete = True
+    
+    @property
+    def size(self) -> int:
+        return self.bytes_downloaded
+    
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+class CachedMedia:
+    """Медиафайл, уже загруженный в Bot API: отправляется по file_id без скачивания"""
+    
+    def __init__(self, file_id: str):
+        self.file_id = file_id
+    
+    async def open(self):
+        pass
+    
+    def payload(self):
+        return self.file_id
+    
+    @property
+    def size(self) -> int:
+        return 0
+    
+    def close(self):
+        pass
+
+
+class FileIdCache:
+    """Персистентный LRU-кэш file_id, которые вернул Bot API
+    
+    Ключ - id фото или документа Telegram вместе с access_hash: один и тот же
+    стикер, GIF или мем имеет одинаковый id во всех сообщениях. file_id
+    действителен только для получившего его бота, поэтому к ключу добавляется
+    id бота. Файл на диске перезаписывается не чаще раза в SAVE_DELAY секунд.
+    """
+    
+    SAVE_DELAY = 10
+    
+    # Поля ответа Bot API, в которых может лежать отправленный файл
+    RESULT_FIELDS = ('photo', 'video', 'animation', 'voice', 'audio', 'document', 'sticker')
+    
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.cache: OrderedDict[str, str] = OrderedDict(load_json(path, {}))
+        self.save_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def key_for(media) -> Optional[str]:
+        """Ключ кэша для медиа сообщения"""
+        if isinstance(media, MessageMediaPhoto) and media.photo:
+            return f"photo:{media.photo.id}:{media.photo.access_hash}"
+        if isinstance(media, MessageMediaDocument) and media.document:
+            return f"doc:{media.document.id}:{media.document.access_hash}"
+        return None
+    
+    @staticmethod
+    def bot_key(media_key: Optional[str], bot_id: str) -> Optional[str]:
+        """Ключ кэша для медиа и конкретного бота"""
+        return f"{media_key}@{bot_id}" if media_key else None
+    
+    def lookup(self, media_key: Optional[str], bots: list) -> Tuple[Any, Optional[str]]:
+        """Ищет file_id медиа у любого бота пула, возвращает (бот, file_id)"""
+        if not media_key or self.max_size <= 0:
+            return None, None
+        for bot in bots:
+            key = self.bot_key(media_key, bot.id)
+            file_id = self.cache.get(key)
+            if file_id is not None:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return bot, file_id
+        self.misses += 1
+        return None, None
+    
+    @classmethod
+    def file_id_from_result(cls, result: dict) -> Optional[str]:
+        """Извлекает file_id из ответа sendPhoto/sendVideo/sendDocument/sendVoice"""
+        for field_name in cls.RESULT_FIELDS:
+            value = result.get(field_name)
+            if isinstance(value, list) and value:
+                # Для фото Bot API возвращает список размеров, берем самый большой
+                value = value[-1]
+            if isinstance(value, dict) and value.get('file_id'):
+                return value['file_id']
+        return None
+    
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if not key or self.max_size <= 0:
+            return None
+        file_id = self.cache.get(key)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return file_id
+    
+    def put(self, key: Optional[str], file_id: Optional[str]):
+        if not key or not file_id or self.max_size <= 0:
+            return
+        self.cache[key] = file_id
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        self._schedule_save()
+    
+    def discard(self, key: str):
+        if self.cache.pop(key, None) is not None:
+            self._schedule_save()
+    
+    def _schedule_save(self):
+        if self.save_task is None or self.save_task.done():
+            self.save_task = asyncio.create_task(self._delayed_save())
+    
+    async def _delayed_save(self):
+        await asyncio.sleep(self.SAVE_DELAY)
+        await self.save()
+    
+    async def save(self):
+        """Сохраняет кэш на диск"""
+        try:
+            await asyncio.to_thread(save_json_atomic, self.path, dict(self.cache))
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кэш file_id: {e}")
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета"""
+        return f"попаданий {self.hits}, промахов {self.misses}, размер {len(self.cache)}"
+
+
+@dataclass
+class DigestEntry:
+    """Текстовый комментарий, ожидающий отправки в составе дайджеста"""
+    author_name: str
+    author_username: str
+    author_id: int
+    time_str: str
+    text: str
+    # Группа и ID комментария: checkpoint держится на нем, пока дайджест не отправлен
+    chat_id: int = 0
+    message_id: int = 0
+
+
+@dataclass
+class MediaGroupItem:
+    """Фото или видео, ожидающее отправки в составе sendMediaGroup"""
+    kind: str
+    message: Any
+    base_caption: str
+    post_link: str
+
+
+class DigestBatcher:
+    """Склейка комментариев в дайджесты
+    
+    Текстовые комментарии копятся по ключу (чат назначения, группа, пост) и
+    отправляются одним сообщением по истечении окна или при достижении лимита
+    количества. Фото и видео за окно отправляются альбомами через sendMediaGroup,
+    отдельным альбомом для каждого чата назначения. После отправки (или ее
+    неудачи, которая уже зафиксирована в outbox) элементы передаются в release.
+    """
+    
+    MESSAGE_LIMIT = 4096
+    MEDIA_GROUP_LIMIT = 10
+    
+    def __init__(self, window: float, max_items: int, send_text, send_media_group, release):
+        self.window = window
+        self.max_items = max(1, max_items)
+        self.send_text = send_text
+        self.send_media_group = send_media_group
+        self.release = release
+        # ключ -> (название канала, ссылка на пост, комментарии)
+        self.texts: Dict[Tuple[int, int, int], Tuple[str, str, list[DigestEntry]]] = {}
+        self.text_timers: Dict[Tuple[int, int, int], asyncio.Task] = {}
+        # чат назначения -> фото/видео будущего альбома
+        self.media: Dict[int, list[MediaGroupItem]] = {}
+        self.media_timers: Dict[int, asyncio.Task] = {}
+        self.flush_tasks: set[asyncio.Task] = set()
+        self.stats_comments = 0
+        self.stats_messages = 0
+    
+    def add_text(self, key: Tuple[int, int, int], channel_title: str, post_link: str, entry: DigestEntry):
+        """Добавляет текстовый комментарий в дайджест поста (ключ начинается с чата назначения)"""
+        self.stats_comments += 1
+        _, _, entries = self.texts.setdefault(key, (channel_title, post_link, []))
+        entries.append(entry)
+        if len(entries) >= self.max_items:
+            self._start_flush(self._flush_text(key))
+        elif key not in self.text_timers:
+            self.text_timers[key] = asyncio.create_task(self._flush_text_later(key))
+    
+    def add_media(self, target: int, item: MediaGroupItem):
+        """Добавляет фото/видео в ближайший альбом для чата назначения"""
+        self.stats_comments += 1
+        items = self.media.setdefault(target, [])
+        items.append(item)
+        if len(items) >= self.MEDIA_GROUP_LIMIT:
+            self._start_flush(self._flush_media(target))
+        elif target not in self.media_timers:
+            self.media_timers[target] = asyncio.create_task(self._flush_media_later(target))
+    
+    def _start_flush(self, coro):
+        task = asyncio.create_task(coro)
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+    
+    async def _flush_text_later(self, key: Tuple[int, int, int]):
+        await asyncio.sleep(self.window)
+        self.text_timers.pop(key, None)
+        await self._flush_text(key)
+    
+    async def _flush_media_later(self, target: int):
+        await asyncio.sleep(self.window)
+        self.media_timers.pop(target, None)
+        await self._flush_media(target)
+    
+    async def _flush_text(self, key: Tuple[int, int, int]):
+        timer = self.text_timers.pop(key, None)
+        if timer and timer is not asyncio.current_task():
+            timer.cancel()
+        batch = self.texts.pop(key, None)
+        if not batch:
+            return
+        channel_title, post_link, entries = batch
+        try:
+            for text in self.render(channel_title, post_link, entries):
+                self.stats_messages += 1
+                await self.send_text(key[0], text)
+        finally:
+            self.release(entries)
+    
+    async def _flush_media(self, target: int):
+        timer = self.media_timers.pop(target, None)
+        if timer and timer is not asyncio.current_task():
+            timer.cancel()
+        pending = self.media.pop(target, [])
+        items, rest = pending[:self.MEDIA_GROUP_LIMIT], pending[self.MEDIA_GROUP_LIMIT:]
+        if rest:
+            self.media[target] = rest
+        if items:
+            self.stats_messages += 1
+            try:
+                await self.send_media_group(target, items)
+            finally:
+                self.release(items)
+    
+    @classmethod
+    def render(cls, channel_title: str, post_link: str, entries: list[DigestEntry]) -> list[str]:
+        """Формирует сообщения дайджеста, каждое не длиннее лимита Telegram"""
+        header = (
+            f"✈️ <b>TG</b> | {channel_title}\n"
+            f"💬 Новых комментариев: {len(entries)}\n"
+            f"━━━━━━━━━━━━━━━━━━"
+        )
+        footer = f"\n\n<a href=\"{post_link}\">🔗 Открыть пост</a>"
+        budget = cls.MESSAGE_LIMIT - len(header) - len(footer)
+        
+        messages = []
+        current = header
+        for entry in entries:
+            author = f"\n👤 {entry.author_name} {entry.author_username} (<code>{entry.author_id}</code>) 🕐 {entry.time_str}\n"
+            text = entry.text
+            overhead = len(author) + len("<blockquote></blockquote>")
+            if overhead + len(text) > budget:
+                # Один очень длинный комментарий обрезаем, чтобы он поместился целиком
+                text = text[:max(0, budget - overhead - 1)] + "…"
+            block = f"{author}<blockquote>{text}</blockquote>"
+            if len(current) + len(block) > cls.MESSAGE_LIMIT - len(footer) and current != header:
+                messages.append(current + footer)
+                current = header
+            current += block
+        messages.append(current + footer)
+        return messages
+    
+    async def flush_all(self):
+        """Отправляет все накопленное (при остановке)"""
+        for key in list(self.texts):
+            await self._flush_text(key)
+        while self.media:
+            await self._flush_media(next(iter(self.media)))
+        if self.flush_tasks:
+            await asyncio.gather(*self.flush_tasks, return_exceptions=True)
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета"""
+        return f"комментариев {self.stats_comments}, отправлено сообщений {self.stats_messages}"
+
+
+class KeywordMatcher:
+    """Поиск множества подстрок за один проход по тексту (автомат Aho-Corasick)
+    
+    Каждое слово помечено значением (индексом правила). Время поиска зависит
+    от длины текста, а не от числа слов, поэтому тысячи ключевых слов
+    проверяются так же быстро, как одно.
+    """
+    
+    def __init__(self):
+        self.goto: list[Dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.outputs: list[frozenset] = [frozenset()]
+    
+    def add(self, word: str, value: int):
+        node = 0
+        for char in word:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append(frozenset())
+                self.goto[node][char] = next_node
+            node = next_node
+        self.outputs[node] = self.outputs[node] | {value}
+    
+    def build(self):
+        """Строит суффиксные ссылки обходом в ширину (после добавления всех слов)"""
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, next_node in self.goto[node].items():
+                pending.append(next_node)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_node] = self.goto[fallback].get(char, 0)
+                self.outputs[next_node] = self.outputs[next_node] | self.outputs[self.fail[next_node]]
+    
+    def search(self, text: str) -> set:
+        """Значения всех слов, встретившихся в тексте"""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if outputs[node]:
+                found |= outputs[node]
+        return found
+
+
+@dataclass
+class RoutingRule:
+    """Правило маршрутизации: условия на канал, автора и текст и чат назначения"""
+    name: str
+    chat_id: int
+    channels: frozenset = frozenset()
+    authors: frozenset = frozenset()
+    exclude_authors: frozenset = frozenset()
+    has_keywords: bool = False
+    regex: Optional[re.Pattern] = None
+
+
+class RuleEngine:
+    """Фильтрация и маршрутизация комментариев по правилам из RULES_FILE
+    
+    Правило срабатывает, если совпали все заданные в нем условия: канал, автор
+    и хотя бы одно ключевое слово или регулярное выражение. Комментарий уходит
+    во все чаты сработавших правил; без совпадений - в чат default или никуда.
+    """
+    
+    def __init__(self, rules: list[RoutingRule], keywords: list[list[str]], default_chat: Optional[int],
+                 deny_authors: frozenset):
+        self.rules = rules
+        self.default_chat = default_chat
+        self.deny_authors = deny_authors
+        self.matcher = KeywordMatcher()
+        for index, words in enumerate(keywords):
+            for word in words:
+                self.matcher.add(word.lower(), index)
+        self.matcher.build()
+        # Правила только с ключевыми словами проверяются лишь при попадании
+        # автомата; остальные (без условий на текст и с regex) - всегда
+        self.scan_always = tuple(
+            index for index, rule in enumerate(rules) if rule.regex or not rule.has_keywords
+        )
+        self.stats_routed = 0
+        self.stats_dropped = 0
+    
+    @classmethod
+    def load(cls, path: str, alert_chat_id: int) -> "RuleEngine":
+        """Читает правила из JSON; ошибки формата - ValueError, файла - OSError"""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("ожидается JSON-объект с полем rules")
+        
+        default = data.get("default", "drop")
+        if default == "drop":
+            default_chat = None
+        elif default == "alert":
+            default_chat = alert_chat_id
+        else:
+            default_chat = int(default)
+        
+        rules, keywords = [], []
+        for index, raw in enumerate(data.get("rules", [])):
+            name = raw.get("name", f"rule{index + 1}")
+            patterns = raw.get("regex", [])
+            if isinstance(patterns, str):
+                patterns = [patterns]
+            try:
+                regex = re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE) if patterns else None
+            except re.error as e:
+                raise ValueError(f"правило {name}: неверное регулярное выражение: {e}")
+            words = [word for word in raw.get("keywords", []) if word]
+            rules.append(RoutingRule(
+                name=name,
+                chat_id=int(raw.get("chat_id", alert_chat_id)),
+                channels=frozenset(ChannelStore.key(ch) for ch in raw.get("channels", [])),
+                authors=frozenset(int(a) for a in raw.get("authors", [])),
+                exclude_authors=frozenset(int(a) for a in raw.get("exclude_authors", [])),
+                has_keywords=bool(words),
+                regex=regex,
+            ))
+            keywords.append(words)
+        deny_authors = frozenset(int(a) for a in data.get("deny_authors", []))
+        return cls(rules, keywords, default_chat, deny_authors)
+    
+    def route(self, channel_username: Optional[str], author_id: Optional[int], text: str) -> Tuple[int, ...]:
+        """Чаты, в которые нужно отправить комментарий (пусто - отбросить)"""
+        targets: list[int] = []
+        if author_id not in self.deny_authors:
+            channel_key = ChannelStore.key(channel_username or "")
+            # Автомат прогоняется по тексту один раз на сообщение
+            keyword_hits = self.matcher.search(text.lower()) if text else set()
+            for index in sorted(keyword_hits.union(self.scan_always)):
+                rule = self.rules[index]
+                if rule.chat_id in targets:
+                    continue
+                if rule.channels and channel_key not in rule.channels:
+                    continue
+                if author_id in rule.exclude_authors or (rule.authors and author_id not in rule.authors):
+                    continue
+                if index not in keyword_hits and rule.regex and not rule.regex.search(text):
+                    continue
+                targets.append(rule.chat_id)
+            if not targets and self.default_chat is not None:
+                targets.append(self.default_chat)
+        
+        if targets:
+            self.stats_routed += 1
+        else:
+            self.stats_dropped += 1
+        return tuple(targets)
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета"""
+        return f"правил {len(self.rules)}, отправлено {self.stats_routed}, отброшено {self.stats_dropped}"
+
+
+class LoadShedder:
+    """Ступенчатая деградация доставки при отставании от потока комментариев
+    
+    Уровень определяется отставанием (от message.date до взятия комментария
+    воркером) и заполненностью очереди: 1 - медиа заменяется текстовым
+    уведомлением, 2 - все уведомления однострочные, 3 - комментарии
+    низкоприоритетных каналов отбрасываются. Уровень поднимается сразу, а
+    снижается на ступень после recovery секунд, в течение которых нагрузка
+    держалась ниже половины порогов текущего уровня.
+    """
+    
+    LEVELS = ("normal", "media_text", "compact", "drop_low")
+    # Заполненность очереди, при которой включаются уровни 1, 2, 3
+    QUEUE_FILL = (0.5, 0.75, 0.9)
+    
+    def __init__(self, lag_thresholds: Tuple[float, ...], queue_capacity: int, recovery: float,
+                 low_priority: frozenset):
+        self.lag_thresholds = lag_thresholds
+        self.queue_capacity = max(1, queue_capacity)
+        self.recovery = recovery
+        self.low_priority = low_priority
+        self.level = 0
+        self.calm_since: Optional[float] = None
+        self.stats_actions: Dict[str, int] = {}
+    
+    def _target(self, lag: float, depth: int, scale: float) -> int:
+        fill = depth / self.queue_capacity
+        level = 0
+        for index, threshold in enumerate(self.lag_thresholds):
+            if lag >= threshold * scale or fill >= self.QUEUE_FILL[index] * scale:
+                level = index + 1
+        return level
+    
+    def observe(self, lag: float, depth: int) -> int:
+        """Учитывает отставание и глубину очереди, возвращает текущий уровень"""
+        target = self._target(lag, depth, 1.0)
+        if target > self.level:
+            logger.warning(
+                f"Деградация: уровень {self.level} → {target} ({self.LEVELS[target]}), "
+                f"отставание {lag:.0f} с, очередь {depth}/{self.queue_capacity}"
+            )
+            self.level = target
+            self.calm_since = None
+        elif self.level and self._target(lag, depth, 0.5) < self.level:
+            now = time.monotonic()
+            if self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since >= self.recovery:
+                self.level -= 1
+                # Следующая ступень - снова после полного периода спокойствия
+                self.calm_since = now
+                logger.info(f"Деградация: нагрузка снизилась, уровень {self.level} ({self.LEVELS[self.level]})")
+        else:
+            self.calm_since = None
+        return self.level
+    
+    def is_low_priority(self, channel_username: Optional[str]) -> bool:
+        return ChannelStore.key(channel_username or "") in self.low_priority
+    
+    def record(self, action: str):
+        self.stats_actions[action] = self.stats_actions.get(action, 0) + 1
+        metrics.shed.inc(action)
+    
+    def report(self) -> str:
+        """Краткая сводка для периодического отчета"""
+        actions = ", ".join(f"{action} {count}" for action, count in self.stats_actions.items())
+        return f"уровень {self.level} ({self.LEVELS[self.level]})" + (f", {actions}" if actions else "")
+
+
+@dataclass
+class CommentJob:
+    """Задача доставки: всё, что нужно воркеру для обработки комментария"""
+    message: Any
+    chat_id: int
+    discussion_post_id: int
+    channel_username: Optional[str]
+    channel_title: str
+    # Чаты для уведомления (по правилам маршрутизации или ALERT_CHAT_ID)
+    targets: Tuple[int, ...] = ()
+    enqueued_at: float = field(default_factory=time.monotonic)
+    log_sampled: bool = True
+    # Сообщение догружено после простоя: его возраст - длительность простоя, а не нагрузка
+    backfill: bool = False
+
+
+class CommentMonitor:
+    """Основной класс мониторинга комментариев"""
+    
+    # Сколько последних принятых сообщений помнить для отсева дублей
+    RECENT_MESSAGES_LIMIT = 20000
+    # Пауза перед повтором догрузки группы после ошибки и число повторов
+    CATCHUP_RETRY_DELAY = 30
+    CATCHUP_RETRIES = 5
+    # Интервал проверки нагрузки при пустой очереди (для снижения уровня деградации), секунды
+    LOAD_CHECK_INTERVAL = 5
+    # Сколько символов комментария показывать в однострочном уведомлении
+    COMPACT_TEXT_LIMIT = 200
+    
+    # Максимальный размер видео, которое можно добавить в альбом дайджеста
+    MEDIA_GROUP_VIDEO_MAX_SIZE = 10 * 1024 * 1024
+    
+    def __init__(self, config: Config):
+        self.config = config
+        # Пул сессий: у каждой свой клиент, каналы делятся консистентным хешированием
+        self.shards = [
+            SessionShard(index, MonitorClient(StringSession(session), config.api_id, config.api_hash))
+            for index, session in enumerate(config.string_sessions)
+        ]
+        for shard in self.shards:
+            shard.flood_limiter.on_flood = lambda seconds, shard=shard: self._on_shard_flood(shard, seconds)
+        # Основной аккаунт
+        self.client = self.shards[0].client
+        self.ring = ConsistentHashRing()
+        self.rebalance_lock = asyncio.Lock()
+        # Маппинг: linked_chat_id -> (channel_username, channel_title)
+        self.linked_groups: Dict[int, Tuple[Optional[str], str]] = {}
+        # Маппинг: linked_chat_id -> InputPeer группы для запросов без резолва
+        self.input_peers: Dict[int, InputPeerChannel] = {}
+        # Маппинг: linked_chat_id -> сессия, через которую группа мониторится
+        self.group_shards: Dict[int, SessionShard] = {}
+        # Маппинг: канал из CHANNELS (ключ ChannelStore) -> linked_chat_id
+        self.channel_chats: Dict[str, int] = {}
+        self.channel_store = ChannelStore(
+            os.path.join(config.state_dir, "channels.json"),
+            config.channel_cache_ttl
+        )
+        self.checkpoints = CheckpointStore(os.path.join(config.state_dir, "checkpoints.json"))
+        # Недавно принятые сообщения (chat_id, message_id): защита от дублей live и догрузки
+        self.recent_messages: OrderedDict[Tuple[int, int], None] = OrderedDict()
+        self.bot_api = BotApiClient(
+            config.bot_api_url,
+            config.bot_api_connections,
+            config.bot_api_keepalive,
+            config.bot_api_timeout
+        )
+        self.bot_pool = BotPool(config.bot_tokens, config.bot_global_rate, config.bot_chat_rate)
+        self.post_resolver = PostResolver(
+            self._shard_for_chat,
+            self.input_peers,
+            config.post_cache_size,
+            config.post_cache_ttl,
+            config.post_batch_delay_ms / 1000
+        )
+        self.sender_cache = SenderCache(config.sender_cache_size, config.sender_cache_ttl)
+        self.log_sampler = LogSampler(config.log_sample_per_sec)
+        self.media_policy = MediaPolicy(config.media_max_sizes, config.media_thumbnails)
+        self.memory_budget = MemoryBudget(config.media_memory_limit, config.media_memory_wait)
+        self.rules: Optional[RuleEngine] = None
+        if config.rules_file:
+            try:
+                self.rules = RuleEngine.load(config.rules_file, config.alert_chat_id)
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.error(f"Не удалось загрузить правила из RULES_FILE: {e}")
+                sys.exit(1)
+            logger.info(f"Загружено правил маршрутизации: {len(self.rules.rules)}")
+        self.file_id_cache = FileIdCache(
+            os.path.join(config.state_dir, "file_ids.json"),
+            config.file_id_cache_size
+        )
+        self.outbox: Optional[Outbox] = None
+        if config.outbox_enabled:
+            self.outbox = Outbox(
+                os.path.join(config.state_dir, "outbox.sqlite3"),
+                config.outbox_commit_ms / 1000
+            )
+        self.digest: Optional[DigestBatcher] = None
+        if config.digest_mode:
+            self.digest = DigestBatcher(
+                config.digest_window,
+                config.digest_max_items,
+                self._send_digest_text,
+                self._send_digest_album,
+                self._release_digest
+            )
+        # Очередь задач доставки между приемом событий и воркерами
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=config.queue_max_size)
+        self.trace: Optional[TraceRecorder] = None
+        if config.trace_file:
+            self.trace = TraceRecorder(config.trace_file, config.trace_redact_text)
+        self.shedder: Optional[LoadShedder] = None
+        if config.shed_lag_thresholds:
+            self.shedder = LoadShedder(
+                config.shed_lag_thresholds,
+                config.queue_max_size,
+                config.shed_recovery,
+                config.low_priority_channels
+            )
+            metrics.gauge("tgmon_shed_level", "Текущий уровень деградации (0 - норма)", lambda: self.shedder.level)
+        self.metrics_runner = None
+        metrics.gauge("tgmon_queue_depth", "Задач в очереди доставки", self.queue.qsize)
+        metrics.gauge("tgmon_monitored_groups", "Групп обсуждений в мониторинге", lambda: len(self.linked_groups))
+        metrics.gauge("tgmon_sessions_available", "Сессий, доступных для каналов", lambda: len(self.ring))
+        metrics.gauge(
+            "tgmon_media_memory_bytes", "Память, зарезервированная под скачиваемые медиа",
+            lambda: self.memory_budget.used
+        )
+        self.background_tasks: list[asyncio.Task] = []
+        # SIGHUP во время настройки откладывается до ее завершения
+        self.setup_done = False
+        self.reload_pending = False
+        self.stats_enqueued = 0
+        self.stats_processed = 0
+        self.stats_failed = 0
+        self.stats_peak_depth = 0
+        
+        try:
+            self.tz = pytz.timezone(config.timezone)
+        except pytz.UnknownTimeZoneError:
+            logger.warning(f"Неизвестная timezone {config.timezone}, используется UTC")
+            self.tz = pytz.UTC
+    
+    async def setup(self):
+        """Настройка: резолв каналов, join, подписка на события"""
+        logger.info("Запуск настройки мониторинга...")
+        # До настройки: по умолчанию SIGHUP завершает процесс, а systemctl reload
+        # может прийти посреди многоминутного холодного запуска
+        self._install_sighup_handler()
+        
+        with startup_profile.phase("connect"):
+            await self._start_shards()
+        
+        with startup_profile.phase("open_delivery"):
+            await self._open_delivery()
+        
+        # Каналы из кэша поднимаем сразу, остальные настраиваем параллельно с ограничением
+        with startup_profile.phase("restore_channels"):
+            restored, missing = self._restore_channels()
+        with startup_profile.phase(f"setup_channels ({len(missing)})"):
+            if missing:
+                async with self.rebalance_lock:
+                    await self._setup_channels(missing)
+            self.channel_store.retain(self.config.channels)
+            await self.channel_store.save()
+        
+        if not self.linked_groups:
+            logger.error("Не удалось подключиться ни к одной дискуссионной группе")
+            sys.exit(1)
+        
+        self._start_workers()
+        if self.config.metrics_port:
+            await self._start_metrics_server()
+        if self.outbox:
+            # Доставляем то, что не успели до перезапуска, и периодически повторяем неудачное
+            self.background_tasks.append(asyncio.create_task(self._replay_outbox()))
+        if restored:
+            self.background_tasks.append(
+                asyncio.create_task(self._revalidate_channels(restored))
+            )
+        if self.config.catchup_enabled:
+            for shard in self.shards:
+                if shard.available:
+                    self.background_tasks.append(asyncio.create_task(self._watch_connection(shard)))
+        self._install_reload_handlers()
+        
+        # Подписываемся на события в linked-группах. Фильтр проверяет текущий
+        # маппинг, поэтому группы, добавленные, удаленные или перенесенные на
+        # другую сессию после подписки, учитываются
+        for shard in self.shards:
+            shard.client.add_event_handler(
+                self._handle_new_message,
+                events.NewMessage(func=lambda event, shard=shard: self._is_monitored_chat(event, shard))
+            )
+        
+        logger.info(f"Мониторинг запущен для {len(self.linked_groups)} дискуссионных групп")
+        if self.config.startup_profile:
+            logger.info("⏱ Профиль запуска:")
+            for line in startup_profile.report():
+                logger.info(line)
+        logger.info("Ожидание новых комментариев...")
+    
+    async def _open_delivery(self):
+        """Открывает пул соединений Bot API, outbox и запись trace"""
+        await self.bot_api.start()
+        if self.outbox:
+            await self.outbox.start()
+        if self.trace:
+            await self.trace.start()
+            logger.info(f"Входящие события записываются в {self.config.trace_file}")
+    
+    async def _start_shards(self):
+        """Подключает сессии пула параллельно и строит кольцо распределения каналов"""
+        async def start_one(shard: SessionShard):
+            try:
+                with startup_profile.phase(f"connect[{shard.index}]"):
+                    await shard.client.start()
+                    me = await shard.client.get_me()
+                shard.name = str(me.id)
+                logger.info(f"Telegram клиент {shard.index} подключен (аккаунт {shard.name})")
+            except Exception as e:
+                shard.available = False
+                logger.error(f"Не удалось подключить сессию {shard.index}: {e}")
+        
+        await asyncio.gather(*(start_one(shard) for shard in self.shards))
+        # Кольцо строим после всех подключений, в порядке пула
+        for shard in self.shards:
+            if shard.available:
+                self.ring.add(shard.name)
+        if not len(self.ring):
+            logger.error("Не удалось подключить ни одной сессии")
+            sys.exit(1)
+    
+    def _shard_for_channel(self, channel_username: str) -> SessionShard:
+        """Сессия, которой канал принадлежит по кольцу среди доступных"""
+        name = self.ring.node_for(ChannelStore.key(channel_username))
+        return next((shard for shard in self.shards if shard.name == name), self.shards[0])
+    
+    def _shard_for_chat(self, chat_id: int) -> SessionShard:
+        """Сессия, через которую мониторится группа"""
+        return self.group_shards.get(chat_id, self.shards[0])
+    
+    def _message_shard(self, message) -> SessionShard:
+        """Сессия, получившая сообщение: только она может скачать его медиа"""
+        for shard in self.shards:
+            if shard.client is message.client:
+                return shard
+        return self._shard_for_chat(message.chat_id)
+    
+    def _is_monitored_chat(self, event, shard: SessionShard) -> bool:
+        """Фильтр событий: сообщение из группы, которую отслеживает эта сессия"""
+        return self.group_shards.get(event.chat_id) is shard
+    
+    def _register_group(
+        self,
+        channel_username: str,
+        shard: SessionShard,
+        linked_chat_id: int,
+        input_peer: InputPeerChannel,
+        channel_user: Optional[str],
+        channel_title: str
+    ):
+        """Добавляет группу обсуждений в мониторинг (или переносит на другую сессию)"""
+        self.linked_groups[linked_chat_id] = (channel_user, channel_title)
+        self.input_peers[linked_chat_id] = input_peer
+        self.group_shards[linked_chat_id] = shard
+        self.channel_chats[ChannelStore.key(channel_username)] = linked_chat_id
+    
+    def _unregister_group(self, channel_username: str):
+        """Убирает группу обсуждений канала из мониторинга"""
+        linked_chat_id = self.channel_chats.pop(ChannelStore.key(channel_username), None)
+        if linked_chat_id is None:
+            return
+        self.linked_groups.pop(linked_chat_id, None)
+        self.input_peers.pop(linked_chat_id, None)
+        self.group_shards.pop(linked_chat_id, None)
+    
+    def _on_shard_flood(self, shard: SessionShard, seconds: int):
+        """Долгий FloodWait выводит сессию из кольца, ее каналы переезжают на другие"""
+        if seconds < self.config.shard_flood_rebalance or not shard.available or len(self.ring) < 2:
+            return
+        logger.warning(f"Сессия {shard.name}: FloodWait {seconds} с, переносим ее каналы на другие аккаунты")
+        shard.available = False
+        self.ring.remove(shard.name)
+        self.background_tasks.append(asyncio.create_task(self._rebalance()))
+        self.background_tasks.append(asyncio.create_task(self._return_shard_after(shard, seconds)))
+    
+    async def _return_shard_after(self, shard: SessionShard, seconds: int):
+        """Возвращает сессию в кольцо после окончания FloodWait"""
+        await asyncio.sleep(seconds)
+        shard.available = True
+        self.ring.add(shard.name)
+        logger.info(f"Сессия {shard.name}: FloodWait закончился, возвращаем ее каналы")
+        await self._rebalance()
+    
+    async def _rebalance(self):
+        """Переносит каналы, чья сессия по кольцу изменилась
+        
+        Старая сессия продолжает мониторить группу, пока новая не вступила в нее:
+        регистрация под новой сессией заменяет старую одной операцией.
+        """
+        async with self.rebalance_lock:
+            moves = [
+                channel_username for channel_username in self.config.channels
+                if (chat_id := self.channel_chats.get(ChannelStore.key(channel_username))) is not None
+                and self.group_shards[chat_id] is not self._shard_for_channel(channel_username)
+            ]
+            if not moves:
+                return
+            logger.info(f"Ребалансировка: переносим каналов {len(moves)}")
+            await self._setup_channels(moves)
+            await self.channel_store.save()
+            # Догружаем то, что могло прийти в момент переключения сессий
+            await self._catch_up_channels(moves)
+    
+    async def _catch_up_channels(self, channels: list[str]):
+        """Догрузка по группам каналов, которые уже мониторились раньше (есть checkpoint)"""
+        if not self.config.catchup_enabled:
+            return
+        for channel_username in channels:
+            chat_id = self.channel_chats.get(ChannelStore.key(channel_username))
+            if chat_id is not None and self.checkpoints.get(chat_id):
+                try:
+                    await self._catch_up_group(chat_id)
+                except Exception as e:
+                    logger.error(f"Ошибка догрузки группы {chat_id}: {e}")
+    
+    def _install_sighup_handler(self):
+        """Подписывает перечитывание каналов и правил на SIGHUP"""
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._on_sighup_signal)
+        except (NotImplementedError, AttributeError):
+            # Нет SIGHUP (Windows) - остается только отслеживание файла
+            pass
+    
+    def _on_sighup_signal(self):
+        if not self.setup_done:
+            if not self.reload_pending:
+                logger.info("SIGHUP во время настройки: перечитаем каналы и правила после ее завершения")
+            self.reload_pending = True
+            return
+        self.background_tasks.append(asyncio.create_task(self._on_sighup()))
+    
+    def _install_reload_handlers(self):
+        """Выполняет отложенный SIGHUP и подписывает перечитывание каналов на изменение CHANNELS_FILE"""
+        self.setup_done = True
+        if self.reload_pending:
+            self.reload_pending = False
+            self.background_tasks.append(asyncio.create_task(self._on_sighup()))
+        if self.config.channels_file and self.config.channels_reload_interval > 0:
+            self.background_tasks.append(asyncio.create_task(self._watch_channels_file()))
+    
+    async def _on_sighup(self):
+        """SIGHUP: перечитывает RULES_FILE и список каналов"""
+        if self.config.rules_file:
+            self._reload_rules()
+        if self.config.channels_file or not self.config.rules_file:
+            await self._reload_channels()
+    
+    def _reload_rules(self):
+        """Заменяет правила маршрутизации; при ошибке в файле остаются прежние"""
+        try:
+            rules = RuleEngine.load(self.config.rules_file, self.config.alert_chat_id)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"Не удалось перечитать RULES_FILE, правила не изменены: {e}")
+            return
+        # Задачи уже в очереди доставляются по старым правилам, новые - по новым
+        self.rules = rules
+        logger.info(f"Правила маршрутизации перечитаны: {len(rules.rules)}")
+    
+    async def _watch_channels_file(self):
+        """Перечитывает CHANNELS_FILE, когда меняется время его изменения"""
+        path = self.config.channels_file
+        last_mtime = None
+        while True:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+            if last_mtime is not None and mtime is not None and mtime != last_mtime:
+                await self._reload_channels()
+            if mtime is not None:
+                last_mtime = mtime
+            await asyncio.sleep(self.config.channels_reload_interval)
+    
+    async def _reload_channels(self):
+        """Применяет новый список каналов без перезапуска
         
+        Настраиваются только добавленные каналы, удаленные просто выходят из
+        фильтра событий; остальные группы мониторятся без перерыва.
+        """
+        if not self.config.channels_file:
+            logger.warning("Получен SIGHUP, но CHANNELS_FILE не задан: CHANNELS применяется только при перезапуске")
+            return
         try:
-            self.tz = pytz.timezone(config.timezone)
-        except pytz.UnknownTimeZoneError:
-            logger.warning(f"Неизвестная timezone {config.timezone}, используется UTC")
-            self.tz = pytz.UTC
+            channels_str = await asyncio.to_thread(Config.read_channels_file, self.config.channels_file)
+        except OSError as e:
+            logger.warning(f"Не удалось перечитать CHANNELS_FILE, список каналов не изменен: {e}")
+            return
+        channels = [ch.strip() for ch in channels_str.split(",") if ch.strip()]
+        if not channels:
+            logger.warning("CHANNELS_FILE пуст, список каналов не изменен")
+            return
+        
+        async with self.rebalance_lock:
+            current = {ChannelStore.key(ch): ch for ch in self.config.channels}
+            wanted = {ChannelStore.key(ch): ch for ch in channels}
+            added = [ch for key, ch in wanted.items() if key not in current]
+            removed = [ch for key, ch in current.items() if key not in wanted]
+            if not added and not removed:
+                return
+            
+            logger.info(
+                f"Список каналов изменен: добавлено {len(added)}, удалено {len(removed)}"
+                + (f" ({', '.join(removed)})" if removed else "")
+            )
+            for channel_username in removed:
+                chat_id = self.channel_chats.get(ChannelStore.key(channel_username))
+                self._unregister_group(channel_username)
+                self.channel_store.discard(channel_username)
+                if chat_id is not None:
+                    self.checkpoints.discard(chat_id)
+            self.config.channels = list(wanted.values())
+            
+            restored, missing = self._restore_channels(added)
+            if missing:
+                await self._setup_channels(missing)
+            # Добавленные каналы начинают с текущих сообщений: checkpoint, оставшийся
+            # от прошлого мониторинга канала, догрузил бы устаревшие комментарии
+            for channel_username in added:
+                chat_id = self.channel_chats.get(ChannelStore.key(channel_username))
+                if chat_id is not None:
+                    self.checkpoints.discard(chat_id)
+            await self.channel_store.save()
+            logger.info(f"Список каналов применен, групп в мониторинге: {len(self.linked_groups)}")
+        
+        if restored:
+            await self._revalidate_channels(restored)
     
-    async def setup(self):
-        """Настройка: резолв каналов, join, подписка на события"""
-        logger.info("Запуск настройки мониторинга...")
+    def _restore_channels(self, channels: Optional[list[str]] = None) -> Tuple[list[str], list[str]]:
+        """Поднимает каналы из персистентного кэша
         
-        await self.client.start()
-        logger.info("Telegram клиент подключен")
+        Возвращает (восстановленные, отсутствующие в кэше) каналы.
+        """
+        restored, missing = [], []
+        primary = self.shards[0].name
+        for channel_username in channels if channels is not None else self.config.channels:
+            entry = self.channel_store.get(channel_username)
+            shard = self._shard_for_channel(channel_username)
+            # access_hash в записи действителен только для аккаунта, который ее создал
+            if not entry or entry.get("session", primary) != shard.name:
+                missing.append(channel_username)
+                continue
+            self._register_group(
+                channel_username,
+                shard,
+                entry["linked_chat_id"],
+                InputPeerChannel(entry["linked_id"], entry["linked_access_hash"]),
+                entry["channel_username"],
+                entry["channel_title"]
+            )
+            restored.append(channel_username)
         
-        # Создаем HTTP сессию для Bot API
-        self.http_session = aiohttp.ClientSession()
+        if restored:
+            logger.info(f"Из кэша восстановлено каналов: {len(restored)}, требуют настройки: {len(missing)}")
+        return restored, missing
+    
+    async def _revalidate_channels(self, channels: list[str]):
+        """Фоновая перепроверка устаревших записей кэша каналов"""
+        stale = [
+            ch for ch in channels
+            if (entry := self.channel_store.get(ch)) and self.channel_store.is_stale(entry)
+        ]
+        if not stale:
+            return
         
-        # Обрабатываем каждый канал
-        for channel_username in self.config.channels:
-            await self._setup_channel(channel_username)
+        logger.info(f"Фоновая перепроверка каналов из кэша: {len(stale)}")
+        semaphore = asyncio.Semaphore(max(1, self.config.setup_concurrency))
         
-        if not self.linked_groups:
-            logger.error("Не удалось подключиться ни к одной дискуссионной группе")
-            sys.exit(1)
+        async def revalidate_one(channel_username: str):
+            async with semaphore:
+                await self._revalidate_channel(channel_username)
         
-        # Подписываемся на события в linked-группах используя entity объекты
-        @self.client.on(events.NewMessage(chats=self.group_entities))
-        async def handle_comment(event):
-            await self._handle_new_message(event)
+        await asyncio.gather(*(revalidate_one(ch) for ch in stale))
+        await self.channel_store.save()
+        logger.info(f"Перепроверка кэша каналов завершена, групп в мониторинге: {len(self.linked_groups)}")
+    
+    async def _revalidate_channel(self, channel_username: str):
+        """Проверяет одним запросом, что привязанная группа канала не изменилась"""
+        entry = self.channel_store.get(channel_username)
+        if not entry:
+            return
+        shard = self.group_shards.get(entry["linked_chat_id"], self.shards[0])
+        try:
+            input_channel = InputChannel(entry["channel_id"], entry["channel_access_hash"])
+            full_channel = await shard.flood_limiter.call(
+                lambda: shard.client(GetFullChannelRequest(input_channel)),
+                f"full_channel({channel_username})"
+            )
+            if full_channel.full_chat.linked_chat_id == entry["linked_id"]:
+                self.channel_store.put(channel_username, entry)
+                return
+            logger.info(f"Группа обсуждений канала {channel_username} изменилась, настраиваем заново")
+        except Exception as e:
+            logger.warning(f"Запись кэша канала {channel_username} недействительна ({e}), настраиваем заново")
         
-        logger.info(f"Мониторинг запущен для {len(self.linked_groups)} дискуссионных групп")
-        logger.info("Ожидание новых комментариев...")
+        # Дорогой путь только для инвалидированных каналов
+        self._unregister_group(channel_username)
+        self.channel_store.discard(channel_username)
+        await self._setup_channel(channel_username)
+    
+    async def _setup_channels(self, channels: list[str]):
+        """Параллельная настройка каналов с лимитом SETUP_CONCURRENCY и сводкой времени"""
+        semaphore = asyncio.Semaphore(max(1, self.config.setup_concurrency))
+        started = time.monotonic()
+        
+        async def setup_one(channel_username: str) -> Tuple[str, bool, float]:
+            async with semaphore:
+                channel_started = time.monotonic()
+                ok = await self._setup_channel(channel_username)
+                elapsed = time.monotonic() - channel_started
+                logger.info(f"⏱ Канал {channel_username}: {elapsed:.2f} с")
+                return channel_username, ok, elapsed
+        
+        results = await asyncio.gather(*(setup_one(ch) for ch in channels))
+        
+        total = time.monotonic() - started
+        succeeded = sum(1 for _, ok, _ in results if ok)
+        summary = (
+            f"⏱ Настройка каналов завершена за {total:.2f} с: "
+            f"успешно {succeeded} из {len(results)}, параллельно {self.config.setup_concurrency}"
+        )
+        if results:
+            slowest = max(results, key=lambda r: r[2])
+            summary += f", самый долгий {slowest[0]} ({slowest[2]:.2f} с)"
+        flood_waits = sum(shard.flood_limiter.flood_waits for shard in self.shards)
+        if flood_waits:
+            flood_wait_total = sum(shard.flood_limiter.flood_wait_total for shard in self.shards)
+            summary += f", FloodWait: {flood_waits} раз ({flood_wait_total} с)"
+        logger.info(summary)
     
-    async def _setup_channel(self, channel_username: str):
-        """Настройка одного канала: резолв, join, получение linked группы"""
+    async def _setup_channel(self, channel_username: str) -> bool:
+        """Настройка одного канала через его сессию: резолв, join, получение linked группы"""
+        shard = self._shard_for_channel(channel_username)
+        client = shard.client
+        limiter = shard.flood_limiter
         try:
             # Резолв канала
             logger.info(f"Обработка канала: {channel_username}")
-            entity = await self.client.get_entity(channel_username)
+            entity = await limiter.call(
+                lambda: client.get_entity(channel_username), f"get_entity({channel_username})"
+            )
             
             if not isinstance(entity, Channel):
                 logger.warning(f"{channel_username} не является каналом, пропускаем")
-                return
+                return False
             
             # Пытаемся вступить в канал
+            joined_channel = False
             try:
-                await self.client(JoinChannelRequest(entity))
+                await limiter.call(
+                    lambda: client(JoinChannelRequest(entity)), f"join({channel_username})"
+                )
+                joined_channel = True
                 logger.info(f"Вступили в канал {channel_username}")
             except UserAlreadyParticipantError:
+                joined_channel = True
                 logger.info(f"Уже подписаны на канал {channel_username}")
             except (ChannelPrivateError, InviteHashExpiredError):
                 logger.warning(f"Канал {channel_username} приватный/недоступен, пропускаем")
-                return
+                return False
             except Exception as e:
                 logger.warning(f"Ошибка при вступлении в канал {channel_username}: {e}")
             
             # Получаем полную информацию о канале
-            full_channel = await self.client(GetFullChannelRequest(entity))
+            full_channel = await limiter.call(
+                lambda: client(GetFullChannelRequest(entity)), f"full_channel({channel_username})"
+            )
             linked_chat_id = full_channel.full_chat.linked_chat_id
             
             if not linked_chat_id:
                 logger.info(f"Канал {channel_username} не имеет привязанной группы обсуждений, пропускаем")
-                return
+                return False
             
             # Получаем информацию о linked группе
-            linked_entity = await self.client.get_entity(linked_chat_id)
+            linked_entity = await limiter.call(
+                lambda: client.get_entity(linked_chat_id), f"get_entity({linked_chat_id})"
+            )
             
             # Пытаемся вступить в группу обсуждений
+            joined_group = False
             try:
-                await self.client(JoinChannelRequest(linked_entity))
+                await limiter.call(
+                    lambda: client(JoinChannelRequest(linked_entity)),
+                    f"join(группа {channel_username})"
+                )
+                joined_group = True
                 logger.info(f"Вступили в группу обсуждений канала {channel_username}")
             except UserAlreadyParticipantError:
+                joined_group = True
                 logger.info(f"Уже состоим в группе обсуждений канала {channel_username}")
             except (ChannelPrivateError, InviteHashExpiredError):
                 logger.warning(
                     f"Группа обсуждений канала {channel_username} приватная/недоступна, пропускаем"
                 )
-                return
+                return False
             except Exception as e:
                 logger.warning(
                     f"Ошибка при вступлении в группу обсуждений {channel_username}: {e}"
                 )
             
             # Конвертируем положительный ID в отрицательный формат для супергрупп
+            linked_id = linked_chat_id
             if linked_chat_id > 0:
                 linked_chat_id = -int(f"100{linked_chat_id}")
                 logger.info(f"Конвертирован ID группы в формат супергруппы: {linked_chat_id}")
             
-            # Сохраняем маппинг и entity объект для подписки на события
+            # Сохраняем маппинг и InputPeer группы для запросов
             channel_title = entity.title
             channel_user = entity.username
-            self.linked_groups[linked_chat_id] = (channel_user, channel_title)
-            self.group_entities.append(linked_entity)
-            logger.info(f"Добавлен entity группы для мониторинга")
+            input_peer = utils.get_input_peer(linked_entity)
+            self._register_group(channel_username, shard, linked_chat_id, input_peer, channel_user, channel_title)
+            logger.info(f"Добавлена группа для мониторинга")
+            
+            # Запоминаем резолв для быстрого перезапуска
+            self.channel_store.put(channel_username, {
+                "channel_id": entity.id,
+                "channel_access_hash": entity.access_hash,
+                "channel_username": channel_user,
+                "channel_title": channel_title,
+                "linked_id": linked_id,
+                "linked_chat_id": linked_chat_id,
+                "linked_access_hash": input_peer.access_hash,
+                "linked_title": getattr(linked_entity, "title", ""),
+                "joined_channel": joined_channel,
+                "joined_group": joined_group,
+                "session": shard.name,
+            })
             
             logger.info(
                 f"✓ Канал {channel_username} настроен. "
-                f"Группа: {linked_chat_id}, Название: {channel_title}"
+                f"Группа: {linked_chat_id}, Название: {channel_title}, сессия: {shard.name}"
             )
+            return True
             
         except Exception as e:
             logger.error(f"Ошибка при обработке канала {channel_username}: {e}")
+            return False
+    
+    def _start_workers(self):
+        """Запускает пул воркеров доставки и периодический отчет о состоянии очереди"""
+        for worker_id in range(1, self.config.delivery_workers + 1):
+            self.background_tasks.append(
+                asyncio.create_task(self._delivery_worker(worker_id))
+            )
+        if self.config.stats_interval > 0:
+            self.background_tasks.append(asyncio.create_task(self._report_stats()))
+        if self.shedder:
+            self.background_tasks.append(asyncio.create_task(self._watch_load()))
+        logger.info(
+            f"Запущено воркеров доставки: {self.config.delivery_workers}, "
+            f"размер очереди: {self.config.queue_max_size}"
+        )
+    
+    async def _start_metrics_server(self):
+        """Поднимает локальный HTTP endpoint /metrics в формате Prometheus"""
+        from aiohttp import web
+        
+        async def handle_metrics(request):
+            return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+        
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        self.metrics_runner = web.AppRunner(app, access_log=None)
+        await self.metrics_runner.setup()
+        site = web.TCPSite(self.metrics_runner, self.config.metrics_host, self.config.metrics_port)
+        await site.start()
+        logger.info(
+            f"Метрики доступны на http://{self.config.metrics_host}:{self.config.metrics_port}/metrics"
+        )
+    
+    async def _stop_workers(self):
+        """Останавливает воркеры и фоновые задачи"""
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks.clear()
+        
+        pending = self.queue.qsize()
+        if pending:
+            logger.warning(f"Остановка: в очереди осталось {pending} необработанных комментариев")
     
     async def _handle_new_message(self, event):
-        """Обработчик новых сообщений в дискуссионных группах"""
-        message = event.message
+        """Обработчик новых сообщений: фильтрует и ставит комментарий в очередь доставки"""
+        if self.trace:
+            channel_info = self.linked_groups.get(event.chat_id)
+            self.trace.record(event.message, event.chat_id, channel_info[0] if channel_info else None)
+        await self._ingest_message(event.message, event.chat_id)
+    
+    async def _ingest_message(self, message, chat_id: int, backfill: bool = False):
+        """Общий вход конвейера для live-событий и догрузки пропущенных сообщений"""
+        # Одно и то же сообщение может прийти и live, и при догрузке
+        message_key = (chat_id, message.id)
+        if message_key in self.recent_messages:
+            return
+        self.recent_messages[message_key] = None
+        while len(self.recent_messages) > self.RECENT_MESSAGES_LIMIT:
+            self.recent_messages.popitem(last=False)
         
-        # DEBUG: Логируем ВСЕ события
-        logger.info(f"🔔 Получено событие: chat_id={event.chat_id}, message_id={message.id}")
-        logger.info(f"   Текст: {message.text[:50] if message.text else '(нет текста)'}...")
+        # Подробный лог пишется только для выборки событий, и только если
+        # категория event включена на уровне DEBUG
+        sampled = event_log.isEnabledFor(logging.DEBUG) and self.log_sampler.sample()
+        log_sampled.set(sampled)
+        event_log.debug("🔔 Получено событие: chat_id=%s, message_id=%s", chat_id, message.id)
+        if sampled:
+            event_log.debug("   Текст: %s...", message.text[:50] if message.text else "(нет текста)")
         
         # Фильтрация: только сообщения с reply (комментарии/ответы)
         if not message.reply_to:
-            logger.info("   ❌ Отфильтровано: нет reply_to")
+            event_log.debug("   ❌ Отфильтровано: нет reply_to")
+            self.checkpoints.finished(chat_id, message.id)
             return
         
         # Определяем ID поста в группе обсуждений
         discussion_post_id = message.reply_to.reply_to_top_id or message.reply_to.reply_to_msg_id
-        logger.info(f"   ✅ Это комментарий к посту/сообщению {discussion_post_id} в группе")
-        chat_id = event.chat_id
+        event_log.debug("   ✅ Это комментарий к посту/сообщению %s в группе", discussion_post_id)
         
         # Получаем информацию о канале из маппинга
         channel_info = self.linked_groups.get(chat_id)
         if not channel_info:
-            logger.warning(f"Получено сообщение из неизвестной группы {chat_id}")
+            event_log.warning("Получено сообщение из неизвестной группы %s", chat_id)
             return
         
         channel_username, channel_title = channel_info
         
-        # Получаем оригинальное сообщение из группы, чтобы найти ID поста в канале
-        channel_post_id = discussion_post_id  # По умолчанию
-        try:
-            original_message = await self.client.get_messages(
-                chat_id, 
-                ids=discussion_post_id
+        # Правила маршрутизации проверяются до резолва поста и автора и до
+        # скачивания медиа: отброшенный комментарий не тратит ни одного запроса
+        targets: Tuple[int, ...] = ()
+        if self.rules:
+            targets = self.rules.route(channel_username, message.sender_id, message.message or "")
+            if not targets:
+                event_log.debug("   ❌ Отфильтровано правилами маршрутизации")
+                self.checkpoints.finished(chat_id, message.id)
+                return
+        
+        self.checkpoints.started(chat_id, message.id)
+        job = CommentJob(
+            message=message,
+            chat_id=chat_id,
+            discussion_post_id=discussion_post_id,
+            channel_username=channel_username,
+            channel_title=channel_title,
+            targets=targets,
+            log_sampled=sampled,
+            backfill=backfill,
+        )
+        await self._enqueue(job)
+    
+    async def _enqueue(self, job: CommentJob):
+        """Ставит задачу в очередь; при заполненной очереди ждет свободного места (backpressure)"""
+        if self.queue.full():
+            logger.warning(
+                f"Очередь доставки заполнена ({self.queue.qsize()}/{self.config.queue_max_size}), "
+                f"прием событий приостановлен"
             )
-            
-            if original_message and original_message.fwd_from:
-                # Извлекаем ID оригинального поста из канала
-                if hasattr(original_message.fwd_from, 'channel_post') and original_message.fwd_from.channel_post:
-                    channel_post_id = original_message.fwd_from.channel_post
-                    logger.info(f"   ✅ Определен ID поста в канале: {channel_post_id}")
-                elif hasattr(original_message.fwd_from, 'saved_from_msg_id') and original_message.fwd_from.saved_from_msg_id:
-                    channel_post_id = original_message.fwd_from.saved_from_msg_id
-                    logger.info(f"   ✅ Определен ID поста в канале: {channel_post_id}")
-            
-            if channel_post_id == discussion_post_id:
-                logger.warning(f"   ⚠️ Не удалось определить ID поста в канале, используем ID из группы")
-                
-        except Exception as e:
-            logger.error(f"   ❌ Ошибка при получении оригинального сообщения: {e}")
-        
-        # Получаем информацию об авторе
-        sender = await event.get_sender()
-        author_first = sender.first_name or ""
-        author_last = sender.last_name or ""
-        author_name = f"{author_first} {author_last}".strip() or "Неизвестный"
-        author_username = f"@{sender.username}" if sender.username else ""
+        await self.queue.put(job)
+        self.stats_enqueued += 1
+        self.stats_peak_depth = max(self.stats_peak_depth, self.queue.qsize())
+    
+    async def _delivery_worker(self, worker_id: int):
+        """Воркер доставки: забирает задачи из очереди и отправляет уведомления"""
+        while True:
+            job = await self.queue.get()
+            try:
+                wait_time = time.monotonic() - job.enqueued_at
+                if wait_time > 5:
+                    logger.warning(
+                        "Воркер %s: комментарий %s ждал в очереди %.1f с", worker_id, job.message.id, wait_time
+                    )
+                await self._process_job(job)
+                self.stats_processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats_failed += 1
+                logger.error(
+                    f"Воркер {worker_id}: ошибка обработки комментария {job.message.id}: {e}",
+                    exc_info=True
+                )
+            finally:
+                self.checkpoints.finished(job.chat_id, job.message.id)
+                self.queue.task_done()
+    
+    async def _watch_connection(self, shard: SessionShard):
+        """Догружает пропущенное сессией при запуске и после каждого ее переподключения"""
+        await self._catch_up(shard)
+        while True:
+            await shard.client.reconnected.wait()
+            shard.client.reconnected.clear()
+            logger.info(f"Сессия {shard.name}: соединение восстановлено, догружаем пропущенные комментарии")
+            await self._catch_up(shard)
+    
+    async def _catch_up(self, shard: SessionShard):
+        """Параллельная догрузка пропущенных сообщений по группам сессии"""
+        chat_ids = [
+            chat_id for chat_id, owner in self.group_shards.items()
+            if owner is shard and self.checkpoints.get(chat_id)
+        ]
+        if not chat_ids:
+            return
+        
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(max(1, self.config.catchup_concurrency))
+        
+        async def catch_up_one(chat_id: int) -> int:
+            async with semaphore:
+                try:
+                    return await self._catch_up_group(chat_id)
+                except Exception as e:
+                    logger.error(f"Ошибка догрузки группы {chat_id}: {e}")
+                    return 0
+        
+        counts = await asyncio.gather(*(catch_up_one(chat_id) for chat_id in chat_ids))
+        logger.info(
+            f"Догрузка завершена за {time.monotonic() - started:.1f} с: "
+            f"сообщений {sum(counts)} из {len(chat_ids)} групп"
+        )
+    
+    async def _catch_up_group(self, chat_id: int) -> int:
+        """Догружает сообщения группы после checkpoint пачками iter_messages
+        
+        Пока догрузка идет, checkpoint группы не обгоняет ее позицию. Проход
+        ограничен CATCHUP_MAX_MESSAGES; если пропущено больше, следующий проход
+        продолжает с места остановки. После ошибки догрузка повторяется через
+        CATCHUP_RETRY_DELAY, чтобы не ждать следующего переподключения.
+        """
+        if chat_id in self.checkpoints.catch_up_positions:
+            # Группа уже догружается (например, ждет повтора после ошибки)
+            return 0
+        position = self.checkpoints.get(chat_id)
+        peer = self.input_peers.get(chat_id, chat_id)
+        shard = self.group_shards.get(chat_id, self.shards[0])
+        self.checkpoints.catch_up_started(chat_id, position)
+        total = 0
+        failures = 0
+        # Отмена (остановка процесса) оставляет checkpoint на позиции догрузки
+        while chat_id in self.linked_groups:
+            try:
+                count, position, complete = await self._fetch_missed(chat_id, peer, shard, position)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                if failures > self.CATCHUP_RETRIES:
+                    logger.error(
+                        f"Группа {chat_id}: догрузка не удалась ({e}), "
+                        f"сообщения после {position} могут быть пропущены"
+                    )
+                    break
+                logger.warning(
+                    f"Группа {chat_id}: ошибка догрузки ({e}), повтор через {self.CATCHUP_RETRY_DELAY} с"
+                )
+                await asyncio.sleep(self.CATCHUP_RETRY_DELAY)
+                continue
+            total += count
+            if complete:
+                break
+            logger.warning(
+                f"Группа {chat_id}: догружено {count} сообщений за проход (CATCHUP_MAX_MESSAGES), "
+                f"продолжаем после {position}"
+            )
+        self.checkpoints.catch_up_finished(chat_id)
+        if total:
+            logger.info(f"Группа {chat_id}: догружено {total} сообщений")
+        return total
+    
+    async def _fetch_missed(self, chat_id: int, peer, shard: SessionShard, last_id: int) -> Tuple[int, int, bool]:
+        """Проход догрузки: подает в конвейер до CATCHUP_MAX_MESSAGES сообщений новее last_id
+        
+        Возвращает (число сообщений, последний полученный ID, дошли ли до конца группы).
+        """
+        count = 0
+        limit = self.config.catchup_max_messages
+        while count < limit:
+            await shard.flood_limiter.wait()
+            try:
+                async for message in shard.client.iter_messages(
+                    peer,
+                    min_id=last_id,
+                    reverse=True,
+                    limit=limit - count
+                ):
+                    # Группу могли убрать из мониторинга во время догрузки
+                    if chat_id not in self.linked_groups:
+                        return count, last_id, True
+                    # Сервисные сообщения live-обработчик тоже не получает
+                    if isinstance(message, MessageService):
+                        self.checkpoints.finished(chat_id, message.id)
+                    else:
+                        await self._ingest_message(message, chat_id, backfill=True)
+                    last_id = message.id
+                    self.checkpoints.catch_up_progress(chat_id, last_id)
+                    count += 1
+                # Сообщений меньше лимита - группа догружена до конца
+                return count, last_id, count < limit
+            except FloodWaitError as e:
+                # Продолжим с последнего принятого сообщения после FloodWait
+                shard.flood_limiter.register(e, f"iter_messages({chat_id})")
+        return count, last_id, False
+    
+    def _shards_report(self) -> str:
+        """Распределение групп и FloodWait по сессиям пула"""
+        parts = []
+        for shard in self.shards:
+            groups = sum(1 for owner in self.group_shards.values() if owner is shard)
+            state = "" if shard.available else ", недоступна"
+            parts.append(
+                f"{shard.name}: групп {groups}, FloodWait {shard.flood_limiter.flood_waits}{state}"
+            )
+        return "; ".join(parts)
+    
+    async def _watch_load(self):
+        """Пока очередь пуста, воркеры не видят новых отставаний - даем уровню деградации снизиться"""
+        while True:
+            await asyncio.sleep(self.LOAD_CHECK_INTERVAL)
+            if self.queue.empty():
+                self.shedder.observe(0.0, 0)
+    
+    async def _report_stats(self):
+        """Периодически логирует глубину очереди и счетчики обработки"""
+        while True:
+            await asyncio.sleep(self.config.stats_interval)
+            logger.info(
+                f"📊 Очередь: {self.queue.qsize()}/{self.config.queue_max_size} "
+                f"(пик {self.stats_peak_depth}), принято {self.stats_enqueued}, "
+                f"обработано {self.stats_processed}, ошибок {self.stats_failed}"
+            )
+            logger.info(f"📊 Bot API: {self.bot_pool.report()}")
+            logger.info(f"📊 Bot API методы: {self.bot_api.report()}")
+            if len(self.shards) > 1:
+                logger.info(f"📊 Сессии: {self._shards_report()}")
+            logger.info(f"📊 Кэш постов: {self.post_resolver.report()}")
+            logger.info(f"📊 Кэш авторов: {self.sender_cache.report()}")
+            logger.info(f"📊 Кэш file_id: {self.file_id_cache.report()}")
+            if self.memory_budget.limit > 0:
+                logger.info(f"📊 Память медиа: {self.memory_budget.report()}")
+            if self.log_sampler.suppressed:
+                logger.info(f"📊 Логи: {self.log_sampler.report()}")
+            if self.rules:
+                logger.info(f"📊 Правила: {self.rules.report()}")
+            if self.shedder:
+                logger.info(f"📊 Деградация: {self.shedder.report()}")
+            if self.digest:
+                logger.info(f"📊 Дайджест: {self.digest.report()}")
+            if self.outbox:
+                logger.info(f"📊 Outbox: {self.outbox.report()}")
+            self.stats_peak_depth = self.queue.qsize()
+    
+    async def _process_job(self, job: CommentJob):
+        """Обработка комментария воркером: резолв поста, автора и отправка уведомления"""
+        message = job.message
+        chat_id = job.chat_id
+        current_comment.set(f"{chat_id}:{message.id}")
+        current_message_time.set(message.date.timestamp())
+        log_sampled.set(job.log_sampled)
+        discussion_post_id = job.discussion_post_id
+        channel_username = job.channel_username
+        channel_title = job.channel_title
+        
+        # Под нагрузкой уведомления упрощаются, чтобы отставание не росло без предела
+        shed_level = 0
+        if self.shedder:
+            # Отставание догруженного сообщения считается от постановки в очередь:
+            # иначе первый же комментарий после долгого простоя включил бы деградацию
+            if job.backfill:
+                lag = time.monotonic() - job.enqueued_at
+            else:
+                lag = time.time() - current_message_time.get()
+            shed_level = self.shedder.observe(lag, self.queue.qsize())
+            if shed_level >= 3 and self.shedder.is_low_priority(channel_username):
+                self.shedder.record("dropped")
+                event_log.debug("   ❌ Отброшено: низкоприоритетный канал при деградации")
+                return
+        
+        # Определяем ID поста в канале по оригинальному сообщению в группе (с кэшем)
+        started = time.monotonic()
+        channel_post_id = await self.post_resolver.resolve(chat_id, discussion_post_id)
+        metrics.stage_seconds.observe(time.monotonic() - started, "resolve_post")
+        if channel_post_id:
+            event_log.debug("   ✅ Определен ID поста в канале: %s", channel_post_id)
+        else:
+            event_log.warning("   ⚠️ Не удалось определить ID поста в канале, используем ID из группы")
+            channel_post_id = discussion_post_id
+        
+        # Получаем информацию об авторе (с кэшем)
+        started = time.monotonic()
+        sender = await self.sender_cache.get(message)
+        metrics.stage_seconds.observe(time.monotonic() - started, "get_sender")
+        author_name = sender.name
+        author_username = sender.username
         author_id = sender.id
         
         # Время комментария
@@ -261,26 +3485,53 @@ class CommentMonitor:
         else:
             post_link = str(channel_post_id)
         
-        logger.info(
-            f"Новый комментарий от {author_name} в {channel_title} к посту {channel_post_id}"
-        )
+        event_log.info("Новый комментарий от %s в %s к посту %s", author_name, channel_title, channel_post_id)
         
         # Формируем базовый caption (без содержимого комментария)
         base_caption = self._format_base_caption(
             channel_title, author_name, author_username, author_id, time_str
         )
         
-        # Определяем тип содержимого и отправляем соответствующее уведомление
-        if message.media:
-            # Медиафайл (с текстом или без)
-            # Если есть текст (подпись к фото/видео), он будет добавлен в caption
-            await self._handle_media_message(message, base_caption, post_link)
-        elif message.text:
-            # Только текстовое сообщение (без медиа)
-            await self._send_text_notification(base_caption, message.text, post_link)
-        else:
-            # Пустое сообщение (редкий случай)
-            await self._send_fallback_notification(base_caption, post_link)
+        # Определяем тип содержимого и отправляем уведомление в каждый чат назначения.
+        # Медиа скачивается один раз: следующие чаты получают его по file_id из кэша
+        info = classify_media(message.media) if message.media else None
+        metrics.comments.inc(info.kind if info else ("text" if message.text else "empty"))
+        if shed_level >= 2:
+            self.shedder.record("compact")
+        elif shed_level >= 1 and info:
+            self.shedder.record("media_text")
+        for target in job.targets or (self.config.alert_chat_id,):
+            current_target_chat.set(target)
+            if shed_level >= 2:
+                # Одна строка без медиа и без ожидания окна дайджеста
+                await self._send_notification(
+                    self._format_compact(channel_title, author_name, message.text, info, post_link),
+                    outcome='compact'
+                )
+            elif shed_level >= 1 and info:
+                # Медиа не скачивается: текстовое уведомление со ссылкой на пост
+                await self._send_fallback_notification(base_caption, post_link)
+            elif info:
+                # Медиафайл (с текстом или без)
+                # Если есть текст (подпись к фото/видео), он будет добавлен в caption
+                await self._handle_media_message(message, base_caption, post_link, info)
+            elif message.text and self.digest:
+                # Текст в режиме дайджеста копится и уходит одним сообщением на пост.
+                # До отправки checkpoint держится на комментарии: если процесс упадет
+                # раньше, догрузка после перезапуска получит его снова
+                self.checkpoints.started(chat_id, message.id)
+                self.digest.add_text(
+                    (target, chat_id, channel_post_id),
+                    channel_title,
+                    post_link,
+                    DigestEntry(author_name, author_username, author_id, time_str, message.text, chat_id, message.id)
+                )
+            elif message.text:
+                # Только текстовое сообщение (без медиа)
+                await self._send_text_notification(base_caption, message.text, post_link)
+            else:
+                # Пустое сообщение (редкий случай)
+                await self._send_fallback_notification(base_caption, post_link)
     
     def _format_base_caption(
         self, 
@@ -308,151 +3559,245 @@ class CommentMonitor:
         )
         await self._send_notification(notification)
     
+    async def _send_digest_text(self, target: int, text: str):
+        """Отправка сообщения дайджеста в его чат назначения"""
+        current_target_chat.set(target)
+        await self._send_notification(text)
+    
+    async def _send_digest_album(self, target: int, items: list[MediaGroupItem]):
+        """Отправка альбома дайджеста в его чат назначения"""
+        current_target_chat.set(target)
+        await self._send_media_group(items)
+    
+    def _digest_media_item(self, kind: str, message, base_caption: str, post_link: str) -> MediaGroupItem:
+        """Элемент альбома дайджеста; checkpoint держится на комментарии до отправки альбома"""
+        self.checkpoints.started(message.chat_id, message.id)
+        return MediaGroupItem(kind, message, base_caption, post_link)
+    
+    def _release_digest(self, entries: list):
+        """Дайджест отправлен: его комментарии больше не держат checkpoint"""
+        for entry in entries:
+            if isinstance(entry, MediaGroupItem):
+                self.checkpoints.finished(entry.message.chat_id, entry.message.id)
+            else:
+                self.checkpoints.finished(entry.chat_id, entry.message_id)
+    
     async def _send_fallback_notification(self, base_caption: str, post_link: str):
         """Отправляет fallback уведомление когда не удалось отправить медиа или контент пустой"""
-        notification = (
-            f"{base_caption}\n"
+        await self._send_notification(self._format_fallback(base_caption, post_link), outcome='fallback')
+    
+    @classmethod
+    def _format_compact(
+        cls, channel_title: str, author_name: str, text: str, info: Optional[MediaInfo], post_link: str
+    ) -> str:
+        """Однострочное уведомление для режима деградации"""
+        snippet = (text or "").replace("\n", " ")
+        if len(snippet) > cls.COMPACT_TEXT_LIMIT:
+            snippet = snippet[:cls.COMPACT_TEXT_LIMIT] + "…"
+        if info:
+            snippet = f"[{info.kind}] {snippet}".rstrip()
+        return f"✈️ {channel_title} | {author_name}: {snippet} <a href=\"{post_link}\">🔗</a>"
+    
+    @staticmethod
+    def _format_fallback(caption: str, post_link: str) -> str:
+        """Текст fallback уведомления: просьба открыть пост, чтобы увидеть медиа"""
+        return (
+            f"{caption}\n"
             f"<b>Пользователь прислал медиафайл, пожалуйста откройте пост чтобы увидеть содержание</b>\n\n"
             f"<a href=\"{post_link}\">🔗 Открыть пост</a>"
         )
-        await self._send_notification(notification)
     
-    async def _handle_media_message(self, message, base_caption: str, post_link: str):
-        """Обрабатывает сообщения с медиафайлами"""
+    async def _handle_media_message(self, message, base_caption: str, post_link: str, info: MediaInfo):
+        """Обрабатывает сообщения с медиафайлами по политике MEDIA_MAX_SIZE_MB"""
         media = message.media
         
-        # Определяем тип медиа и размер
-        if isinstance(media, MessageMediaPhoto):
+        if info.kind == "other":
+            # Неизвестный тип медиа
+            media_log.warning("   ⚠️ Неизвестный тип медиа: %s", type(media))
+            await self._send_fallback_notification(base_caption, post_link)
+            return
+        
+        if info.kind != "photo":
+            media_log.debug("   📎 Обнаружен документ: mime=%s, size=%s bytes", info.mime_type, info.size)
+        
+        # Стикеры и так пересылаются по ссылке, для остального - режим MEDIA_DELIVERY
+        if self.config.media_delivery != "upload" and info.kind != "sticker":
+            metrics.media_tiers.inc(info.kind, self.config.media_delivery)
+            await self._send_by_reference(message, base_caption, post_link, info)
+            return
+        await self._upload_media(message, base_caption, post_link, info)
+    
+    async def _upload_media(self, message, base_caption: str, post_link: str, info: MediaInfo):
+        """Скачивает медиа и загружает в Bot API (или превью/текст по MediaPolicy)"""
+        # Стикеры пересылаются через Telethon без скачивания, размер не важен
+        tier = MediaPolicy.FULL if info.kind == "sticker" else self.media_policy.decide(info)
+        metrics.media_tiers.inc(info.kind, tier)
+        if tier == MediaPolicy.THUMB:
+            media_log.info("   🖼️ Файл %s слишком большой (%s bytes), отправляем превью", info.kind, info.size)
+            await self._send_thumbnail(message, base_caption, post_link, info)
+            return
+        if tier == MediaPolicy.TEXT:
+            media_log.info("   ⚠️ Файл %s слишком большой (%s bytes), отправляем fallback", info.kind, info.size)
+            await self._send_fallback_notification(base_caption, post_link)
+            return
+        
+        if info.kind == "photo":
             # Фото - всегда отправляем
-            logger.info("   📷 Обнаружено фото, отправляем...")
-            await self._send_photo(message, base_caption, post_link)
+            if self.digest:
+                media_log.debug("   📷 Обнаружено фото, добавляем в альбом...")
+                self.digest.add_media(self._target_chat(), self._digest_media_item('photo', message, base_caption, post_link))
+            else:
+                media_log.debug("   📷 Обнаружено фото, отправляем...")
+                await self._send_photo(message, base_caption, post_link)
+        elif info.kind == "video":
+            if self.digest and info.size <= self.MEDIA_GROUP_VIDEO_MAX_SIZE:
+                # Альбом скачивается в память целиком, поэтому в него идут только небольшие видео
+                media_log.debug("   🎥 Добавляем видео в альбом...")
+                self.digest.add_media(self._target_chat(), self._digest_media_item('video', message, base_caption, post_link))
+            else:
+                media_log.debug("   🎥 Отправляем видео...")
+                await self._send_video(message, base_caption, post_link)
+        elif info.kind == "voice":
+            media_log.debug("   🎤 Отправляем голосовое сообщение...")
+            await self._send_voice(message, base_caption, post_link)
+        else:
+            media_log.debug({
+                "sticker": "   🖼️ Отправляем стикер...",
+                "gif": "   🎬 Отправляем GIF/анимацию...",
+                "audio": "   🎵 Отправляем аудио как документ...",
+            }.get(info.kind, "   📄 Отправляем документ..."))
+            await self._send_document(message, base_caption, post_link, info)
+    
+    async def _send_by_reference(self, message, base_caption: str, post_link: str, info: MediaInfo):
+        """Отправляет медиа с user-сессии по ссылке: файл копирует сам Telegram
         
-        elif isinstance(media, MessageMediaDocument):
-            doc = media.document
-            mime_type = doc.mime_type if hasattr(doc, 'mime_type') else ''
-            file_size = doc.size if hasattr(doc, 'size') else 0
-            
-            logger.info(f"   📎 Обнаружен документ: mime={mime_type}, size={file_size} bytes")
-            
-            # Проверяем тип документа
-            if 'video' in mime_type or any(
-                attr for attr in doc.attributes 
-                if attr.__class__.__name__ == 'DocumentAttributeVideo'
-            ):
-                # Видео
-                if file_size > 10 * 1024 * 1024:  # 10 МБ
-                    logger.info(f"   ⚠️ Видео слишком большое ({file_size} bytes), отправляем fallback")
-                    await self._send_fallback_notification(base_caption, post_link)
-                else:
-                    logger.info("   🎥 Отправляем видео...")
-                    await self._send_video(message, base_caption, post_link)
-            
-            elif any(
-                attr for attr in doc.attributes 
-                if attr.__class__.__name__ == 'DocumentAttributeSticker'
-            ):
-                # Стикер
-                logger.info("   🖼️ Отправляем стикер...")
-                await self._send_document(message, base_caption, post_link)
-            
-            elif any(
-                attr for attr in doc.attributes 
-                if attr.__class__.__name__ == 'DocumentAttributeAnimated'
-            ) or 'gif' in mime_type:
-                # GIF или анимация
-                logger.info("   🎬 Отправляем GIF/анимацию...")
-                await self._send_document(message, base_caption, post_link)
-            
-            elif 'audio' in mime_type or any(
-                attr for attr in doc.attributes 
-                if attr.__class__.__name__ in ['DocumentAttributeAudio']
-            ):
-                # Голосовое или аудио
-                is_voice = any(
-                    attr for attr in doc.attributes 
-                    if attr.__class__.__name__ == 'DocumentAttributeAudio' 
-                    and hasattr(attr, 'voice') and attr.voice
+        Байты не проходят через хост, поэтому время доставки не зависит от
+        размера файла. Если Telegram отказал (например, в группе запрещена
+        пересылка), медиа уходит обычным путем через Bot API.
+        """
+        full_caption = base_caption
+        if message.text:
+            full_caption = f"{base_caption}\n<blockquote>{message.text}</blockquote>"
+        caption = f"{full_caption}\n\n<a href=\"{post_link}\">🔗 Открыть пост</a>"
+        
+        # Отдельный вид записи: у загрузки при неудаче будет своя запись 'media' с тем же текстом
+        outbox_key, deliver = await self._outbox_begin('reference', self._format_fallback(full_caption, post_link))
+        if not deliver:
+            delivery_log.debug("   Медиафайл уже доставлен ранее, пропускаем")
+            return
+        
+        # Отправляет сессия, получившая комментарий: ссылка на файл действительна для нее
+        shard = self._message_shard(message)
+        started = time.monotonic()
+        try:
+            if self.config.media_delivery == "forward":
+                # Заголовок идет следом: если пересылка не удастся, его отправит обычный путь
+                await shard.flood_limiter.call(
+                    lambda: shard.client.forward_messages(self._target_chat(), message),
+                    "forward_messages",
+                    FloodWaitLimiter.HOT_PATH_MAX_WAIT
                 )
-                if is_voice:
-                    logger.info("   🎤 Отправляем голосовое сообщение...")
-                    await self._send_voice(message, base_caption, post_link)
-                else:
-                    logger.info("   🎵 Отправляем аудио как документ...")
-                    await self._send_document(message, base_caption, post_link)
             else:
-                # Другой документ
-                logger.info("   📄 Отправляем документ...")
-                await self._send_document(message, base_caption, post_link)
+                await shard.flood_limiter.call(
+                    lambda: shard.client.send_file(
+                        self._target_chat(), message.media, caption=caption, parse_mode='html'
+                    ),
+                    "send_file",
+                    FloodWaitLimiter.HOT_PATH_MAX_WAIT
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            media_log.warning("   ⚠️ Не удалось отправить %s по ссылке (%s), загружаем файл", info.kind, e)
+            # Запись остается открытой, пока загрузка не завершится: при падении
+            # посередине после перезапуска будет доставлен текст
+            try:
+                await self._upload_media(message, base_caption, post_link, info)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._outbox_finish(outbox_key, False)
+                raise
+            self._outbox_finish(outbox_key, True)
+            return
+        
+        metrics.stage_seconds.observe(time.monotonic() - started, "reference")
+        self._outbox_finish(outbox_key, True)
+        if self.config.media_delivery == "forward":
+            await self._send_notification(f"{caption}\n<i>⬆️ Медиафайл переслан выше</i>")
         else:
-            # Неизвестный тип медиа
-            logger.warning(f"   ⚠️ Неизвестный тип медиа: {type(media)}")
+            delivery_log.debug("   ✅ Медиафайл отправлен по ссылке (%s)", info.kind)
+            metrics.notifications.inc("sent")
+    
+    async def _send_thumbnail(self, message, base_caption: str, post_link: str, info: MediaInfo):
+        """Отправляет вместо большого файла его миниатюру как фото-превью"""
+        try:
+            size_mb = info.size / (1024 * 1024)
+            full_caption = (
+                f"{base_caption}\n"
+                f"<i>Превью: {info.filename or info.kind}, {size_mb:.1f} МБ - полный файл в посте</i>"
+            )
+            if message.text:
+                full_caption = f"{full_caption}\n<blockquote>{message.text}</blockquote>"
+            
+            await self._relay_media(
+                message,
+                'sendPhoto',
+                full_caption,
+                'preview.jpg',
+                post_link,
+                thumbnail=True
+            )
+        except Exception as e:
+            media_log.error("   ❌ Ошибка при отправке превью: %s", e)
             await self._send_fallback_notification(base_caption, post_link)
     
     async def _send_photo(self, message, base_caption: str, post_link: str):
         """Скачивает и отправляет фото с caption"""
         try:
-            # Скачиваем фото в память
-            photo_bytes = BytesIO()
-            await message.download_media(file=photo_bytes)
-            photo_bytes.seek(0)
-            
             # Если есть текст (подпись к фото), добавляем его в caption
             full_caption = base_caption
             if message.text:
                 full_caption = f"{base_caption}\n<blockquote>{message.text}</blockquote>"
             
             # Отправляем через Bot API
-            await self._send_media_to_bot(
+            await self._relay_media(
+                message,
                 'sendPhoto',
-                photo_bytes,
                 full_caption,
                 'photo.jpg',
                 post_link
             )
         except Exception as e:
-            logger.error(f"   ❌ Ошибка при отправке фото: {e}")
+            media_log.error("   ❌ Ошибка при отправке фото: %s", e)
             await self._send_fallback_notification(base_caption, post_link)
     
     async def _send_video(self, message, base_caption: str, post_link: str):
         """Скачивает и отправляет видео с caption"""
         try:
-            # Скачиваем видео в память
-            video_bytes = BytesIO()
-            await message.download_media(file=video_bytes)
-            video_bytes.seek(0)
-            
             # Если есть текст (подпись к видео), добавляем его в caption
             full_caption = base_caption
             if message.text:
                 full_caption = f"{base_caption}\n<blockquote>{message.text}</blockquote>"
             
             # Отправляем через Bot API
-            await self._send_media_to_bot(
+            await self._relay_media(
+                message,
                 'sendVideo',
-                video_bytes,
                 full_caption,
                 'video.mp4',
                 post_link
             )
         except Exception as e:
-            logger.error(f"   ❌ Ошибка при отправке видео: {e}")
+            media_log.error("   ❌ Ошибка при отправке видео: %s", e)
             await self._send_fallback_notification(base_caption, post_link)
     
-    async def _send_document(self, message, base_caption: str, post_link: str):
+    async def _send_document(self, message, base_caption: str, post_link: str, info: MediaInfo):
         """Скачивает и отправляет документ (стикер/GIF) с caption"""
         try:
-            # Проверяем, это стикер или нет
-            is_sticker = False
-            if hasattr(message.media, 'document'):
-                doc = message.media.document
-                is_sticker = any(
-                    attr for attr in doc.attributes 
-                    if attr.__class__.__name__ == 'DocumentAttributeSticker'
-                )
-            
             # Для стикеров: сначала отправляем текст, потом стикер
             # (т.к. стикеры не поддерживают caption)
-            if is_sticker:
+            if info.kind == "sticker":
                 # Отправляем информацию как отдельное текстовое сообщение
                 info_text = f"{base_caption}\n\n<b>📩 Пользователь отправил стикер</b>\n\n<a href=\"{post_link}\">🔗 Открыть пост</a>"
                 await self._send_notification(info_text)
@@ -460,27 +3805,18 @@ class CommentMonitor:
                 # Отправляем стикер через Telethon (пересылка)
                 # Это единственный надежный способ отправить стикер как стикер
                 try:
-                    await self.client.send_file(
-                        self.config.alert_chat_id,
-                        message.media
+                    shard = self._message_shard(message)
+                    await shard.flood_limiter.call(
+                        lambda: shard.client.send_file(self._target_chat(), message.media),
+                        "send_file",
+                        FloodWaitLimiter.HOT_PATH_MAX_WAIT
                     )
-                    logger.info("   ✅ Стикер успешно отправлен")
+                    delivery_log.debug("   ✅ Стикер успешно отправлен")
                 except Exception as e:
-                    logger.error(f"   ❌ Ошибка при отправке стикера: {e}")
+                    media_log.error("   ❌ Ошибка при отправке стикера: %s", e)
             else:
                 # Для GIF и других документов - обычная отправка с caption
-                doc_bytes = BytesIO()
-                await message.download_media(file=doc_bytes)
-                doc_bytes.seek(0)
-                
-                # Определяем имя файла
-                filename = 'document'
-                if hasattr(message.media, 'document'):
-                    doc = message.media.document
-                    for attr in doc.attributes:
-                        if hasattr(attr, 'file_name'):
-                            filename = attr.file_name
-                            break
+                filename = info.filename or 'document'
                 
                 # Если есть текст, добавляем в caption
                 full_caption = base_caption
@@ -488,53 +3824,131 @@ class CommentMonitor:
                     full_caption = f"{base_caption}\n<blockquote>{message.text}</blockquote>"
                 
                 # Отправляем через Bot API
-                await self._send_media_to_bot(
+                await self._relay_media(
+                    message,
                     'sendDocument',
-                    doc_bytes,
                     full_caption,
                     filename,
                     post_link
                 )
         except Exception as e:
-            logger.error(f"   ❌ Ошибка при отправке документа: {e}")
+            media_log.error("   ❌ Ошибка при отправке документа: %s", e)
             await self._send_fallback_notification(base_caption, post_link)
     
     async def _send_voice(self, message, base_caption: str, post_link: str):
         """Скачивает и отправляет голосовое сообщение с caption"""
         try:
-            # Скачиваем голосовое в память
-            voice_bytes = BytesIO()
-            await message.download_media(file=voice_bytes)
-            voice_bytes.seek(0)
-            
             # Если есть текст (подпись к голосовому), добавляем его в caption
             full_caption = base_caption
             if message.text:
                 full_caption = f"{base_caption}\n<blockquote>{message.text}</blockquote>"
             
             # Отправляем через Bot API
-            await self._send_media_to_bot(
+            await self._relay_media(
+                message,
                 'sendVoice',
-                voice_bytes,
                 full_caption,
                 'voice.ogg',
                 post_link
             )
         except Exception as e:
-            logger.error(f"   ❌ Ошибка при отправке голосового: {e}")
+            media_log.error("   ❌ Ошибка при отправке голосового: %s", e)
             await self._send_fallback_notification(base_caption, post_link)
     
+    async def _relay_media(
+        self,
+        message,
+        method: str,
+        caption: str,
+        filename: str,
+        post_link: str,
+        thumbnail: bool = False
+    ):
+        """Передает медиафайл сообщения в Bot API с записью в outbox
+        
+        Пока медиа в пути, в outbox лежит его текстовая версия: если процесс
+        остановится посередине, после перезапуска будет доставлен текст.
+        """
+        outbox_key, deliver = await self._outbox_begin('media', self._format_fallback(caption, post_link))
+        if not deliver:
+            delivery_log.debug("   Медиафайл уже доставлен ранее, пропускаем")
+            return
+        try:
+            await self._deliver_media(message, method, caption, filename, post_link, thumbnail)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Вызывающий отправит fallback уведомление отдельной записью outbox
+            self._outbox_finish(outbox_key, True)
+            raise
+        self._outbox_finish(outbox_key, True)
+    
+    async def _deliver_media(
+        self,
+        message,
+        method: str,
+        caption: str,
+        filename: str,
+        post_link: str,
+        thumbnail: bool = False
+    ):
+        """Передает медиафайл (или его миниатюру) в Bot API в режиме MEDIA_RELAY_MODE"""
+        # Этот файл уже отправлялся - переиспользуем file_id без скачивания и загрузки
+        media_key = FileIdCache.key_for(message.media)
+        if media_key and thumbnail:
+            media_key = f"{media_key}:thumb"
+        # file_id действителен только для получившего его бота - отправляем через него
+        bot, file_id = self.file_id_cache.lookup(media_key, self.bot_pool.bots)
+        if file_id:
+            # Сбой сети или 5xx после всех ретраев пробрасывается дальше: запись кэша
+            # остается, вызывающий отправит текстовое уведомление
+            try:
+                await self._send_media_to_bot(method, CachedMedia(file_id), caption, filename, post_link, bot=bot)
+                return
+            except BotApiError as e:
+                if not e.invalid_file:
+                    # Бот не в чате, неверный caption и т.п.: загрузка получит тот же отказ
+                    raise
+                logger.warning(f"   ⚠️ file_id больше не действителен, загружаем файл: {e}")
+                self.file_id_cache.discard(FileIdCache.bot_key(media_key, bot.id))
+        
+        # Фото и миниатюры небольшие и всегда скачиваются в память
+        if thumbnail:
+            source = ThumbnailMedia(message, self._message_shard(message).flood_limiter)
+            reserve = largest_variant_size(message.media.document.thumbs)
+        elif self.config.media_relay_mode == "stream" and not isinstance(message.media, MessageMediaPhoto):
+            source = StreamingMedia(message, self.config.stream_chunk_size, self._message_shard(message).flood_limiter)
+            # В памяти только пара чанков, остальное - во временном файле
+            reserve = min(media_byte_size(message.media), 2 * self.config.stream_chunk_size)
+        else:
+            source = BufferedMedia(message, self._message_shard(message).flood_limiter)
+            reserve = media_byte_size(message.media)
+        
+        # Место в бюджете памяти резервируется до скачивания по известному размеру;
+        # без места вызывающий отправит текстовое уведомление
+        if not await self.memory_budget.acquire(reserve):
+            raise Exception(f"нет свободной памяти под медиафайл ({reserve} bytes) за {self.memory_budget.timeout} с")
+        try:
+            await source.open()
+            result = await self._send_media_to_bot(method, source, caption, filename, post_link)
+            self.file_id_cache.put(
+                FileIdCache.bot_key(media_key, current_bot.get().id), FileIdCache.file_id_from_result(result)
+            )
+        finally:
+            source.close()
+            self.memory_budget.release(reserve)
+    
     async def _send_media_to_bot(
         self, 
         method: str, 
-        media_bytes: BytesIO, 
+        source, 
         caption: str,
         filename: str,
-        post_link: str
-    ):
-        """Отправляет медиафайл через Bot API с caption"""
-        url = f"https://api.telegram.org/bot{self.config.bot_token}/{method}"
-        
+        post_link: str,
+        max_retries: int = 3,
+        bot: Optional[BotSlot] = None
+    ) -> dict:
+        """Отправляет медиафайл через Bot API с caption, возвращает result ответа"""
         # Добавляем ссылку на пост в caption
         full_caption = f"{caption}\n\n<a href=\"{post_link}\">🔗 Открыть пост</a>"
         
@@ -547,88 +3961,325 @@ class CommentMonitor:
         }
         field_name = field_name_map.get(method, 'document')
         
-        max_retries = 3
-        for attempt in range(1, max_retries + 1):
-            try:
-                # Создаем form data
-                data = aiohttp.FormData()
-                data.add_field('chat_id', str(self.config.alert_chat_id))
-                data.add_field('caption', full_caption)
-                data.add_field('parse_mode', 'HTML')
-                
-                # Добавляем файл
-                media_bytes.seek(0)  # Возвращаемся в начало
+        def make_request() -> dict:
+            # FormData нельзя отправить повторно, поэтому собираем на каждую попытку
+            data = aiohttp.FormData()
+            data.add_field('chat_id', str(self._target_chat()))
+            data.add_field('caption', full_caption)
+            data.add_field('parse_mode', 'HTML')
+            
+            # Добавляем файл
+            payload = source.payload()
+            if isinstance(payload, str):
+                # file_id передается обычным полем формы
+                data.add_field(field_name, payload)
+            else:
                 data.add_field(
                     field_name,
-                    media_bytes,
+                    payload,
                     filename=filename,
                     content_type='application/octet-stream'
                 )
+            return {'data': data}
+        
+        result = await self._call_bot_api(method, make_request, max_retries, bot)
+        if result is None:
+            # Если не удалось отправить медиа, выбрасываем исключение
+            raise Exception(f"Не удалось отправить медиа после {max_retries} попыток")
+        delivery_log.debug("   ✅ Медиафайл успешно отправлен (%s)", method)
+        metrics.notifications.inc("sent")
+        metrics.bytes.inc("uploaded", value=source.size)
+        return result
+    
+    async def _send_media_group(self, items: list[MediaGroupItem]):
+        """Отправляет накопленные фото/видео одним альбомом sendMediaGroup"""
+        if len(items) == 1:
+            await self._send_media_item(items[0])
+            return
+        
+        # Текстовые версии элементов альбома лежат в outbox, пока альбом в пути
+        outbox_keys = []
+        for item in items:
+            caption = item.base_caption
+            if item.message.text:
+                caption = f"{caption}\n<blockquote>{item.message.text}</blockquote>"
+            outbox_key, _ = await self._outbox_begin('album', self._format_fallback(caption, item.post_link))
+            outbox_keys.append(outbox_key)
+        
+        sources = []
+        # Альбом закрепляется за одним ботом: file_id из кэша должны принадлежать ему
+        bot = self.bot_pool.select(self._target_chat())
+        cache_keys = [FileIdCache.bot_key(FileIdCache.key_for(item.message.media), bot.id) for item in items]
+        file_ids = [self.file_id_cache.get(cache_key) for cache_key in cache_keys]
+        # Память под все скачиваемые файлы альбома резервируется разом: частичные
+        # резервы двух альбомов могли бы ждать друг друга бесконечно
+        reserve = sum(
+            media_byte_size(item.message.media) for item, file_id in zip(items, file_ids) if not file_id
+        )
+        reserved = False
+        try:
+            if not await self.memory_budget.acquire(reserve):
+                raise Exception(f"нет свободной памяти под альбом ({reserve} bytes)")
+            reserved = True
+            media = []
+            files = {}
+            for index, (item, file_id) in enumerate(zip(items, file_ids)):
+                caption = item.base_caption
+                if item.message.text:
+                    caption = f"{caption}\n<blockquote>{item.message.text}</blockquote>"
+                caption = f"{caption}\n\n<a href=\"{item.post_link}\">🔗 Открыть пост</a>"
                 
-                async with self.http_session.post(url, data=data) as response:
-                    if response.status == 200:
-                        logger.info(f"   ✅ Медиафайл успешно отправлен ({method})")
-                        return
-                    else:
-                        error_text = await response.text()
-                        logger.warning(
-                            f"   Попытка {attempt}/{max_retries}: "
-                            f"Ошибка отправки медиа (status {response.status}): {error_text}"
-                        )
-            except Exception as e:
-                logger.warning(f"   Попытка {attempt}/{max_retries}: Ошибка отправки медиа: {e}")
+                if file_id:
+                    media_ref = file_id
+                else:
+                    source = BufferedMedia(item.message, self._message_shard(item.message).flood_limiter)
+                    sources.append(source)
+                    await source.open()
+                    attach_name = f"file{index}"
+                    filename = 'photo.jpg' if item.kind == 'photo' else 'video.mp4'
+                    files[attach_name] = (source, filename)
+                    media_ref = f"attach://{attach_name}"
+                media.append({
+                    'type': item.kind,
+                    'media': media_ref,
+                    'caption': caption,
+                    'parse_mode': 'HTML'
+                })
             
-            if attempt < max_retries:
-                delay = 2 ** (attempt - 1)
-                await asyncio.sleep(delay)
+            def make_request() -> dict:
+                data = aiohttp.FormData()
+                data.add_field('chat_id', str(self._target_chat()))
+                data.add_field('media', json.dumps(media, ensure_ascii=False))
+                for attach_name, (source, filename) in files.items():
+                    data.add_field(
+                        attach_name,
+                        source.payload(),
+                        filename=filename,
+                        content_type='application/octet-stream'
+                    )
+                return {'data': data}
+            
+            result = await self._call_bot_api('sendMediaGroup', make_request, max_retries=3, bot=bot)
+            if result is None:
+                raise Exception("Не удалось отправить альбом после 3 попыток")
+            for cache_key, sent in zip(cache_keys, result):
+                self.file_id_cache.put(cache_key, FileIdCache.file_id_from_result(sent))
+            delivery_log.debug("   ✅ Альбом из %s медиафайлов успешно отправлен", len(items))
+            metrics.notifications.inc("sent", value=len(items))
+            metrics.bytes.inc("uploaded", value=sum(source.size for source in sources))
+            for outbox_key in outbox_keys:
+                self._outbox_finish(outbox_key, True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Элементы уйдут по одному, каждый со своей записью outbox и своим резервом памяти
+            for source in sources:
+                source.close()
+            sources = []
+            if reserved:
+                self.memory_budget.release(reserve)
+                reserved = False
+            for outbox_key in outbox_keys:
+                self._outbox_finish(outbox_key, True)
+            media_log.error("   ❌ Ошибка при отправке альбома, отправляем по одному: %s", e)
+            for item in items:
+                await self._send_media_item(item)
+        finally:
+            for source in sources:
+                source.close()
+            if reserved:
+                self.memory_budget.release(reserve)
+    
+    async def _send_media_item(self, item: MediaGroupItem):
+        """Отправляет элемент альбома отдельным сообщением"""
+        if item.kind == 'photo':
+            await self._send_photo(item.message, item.base_caption, item.post_link)
+        else:
+            await self._send_video(item.message, item.base_caption, item.post_link)
+    
+    async def _send_notification(self, text: str, outcome: str = 'sent') -> bool:
+        """Отправка уведомления через Bot API с ретраями и записью в outbox
+        
+        outcome - метка исхода для метрик при успешной доставке (sent/fallback/compact).
+        """
+        outbox_key, deliver = await self._outbox_begin('message', text)
+        if not deliver:
+            logger.info("Уведомление уже доставлено ранее, пропускаем")
+            return True
         
-        # Если не удалось отправить медиа, выбрасываем исключение
-        raise Exception(f"Не удалось отправить медиа после {max_retries} попыток")
+        payload = self._message_payload(text)
+        max_retries = 5
+        try:
+            result = await self._call_bot_api('sendMessage', BotApiClient.json_request(payload), max_retries)
+        except BotApiError as e:
+            logger.error(f"Bot API отверг уведомление, повторов не будет: {e}")
+            if self.outbox and outbox_key:
+                self.outbox.mark_failed(outbox_key)
+            metrics.notifications.inc("failed")
+            return False
+        if result is None:
+            logger.error(f"Не удалось отправить уведомление после {max_retries} попыток")
+            if self.outbox:
+                logger.info("Уведомление сохранено в outbox и будет отправлено повторно")
+            self._outbox_finish(outbox_key, False)
+            metrics.notifications.inc("failed")
+            return False
+        delivery_log.debug("Уведомление успешно отправлено")
+        metrics.notifications.inc(outcome)
+        self._outbox_finish(outbox_key, True)
+        return True
     
-    async def _send_notification(self, text: str):
-        """Отправка уведомления через Bot API с ретраями"""
-        url = f"https://api.telegram.org/bot{self.config.bot_token}/sendMessage"
-        payload = {
-            "chat_id": self.config.alert_chat_id,
+    def _target_chat(self) -> int:
+        """Чат назначения текущего уведомления (по правилам маршрутизации или ALERT_CHAT_ID)"""
+        return current_target_chat.get() or self.config.alert_chat_id
+    
+    def _message_payload(self, text: str) -> dict:
+        """Параметры sendMessage для уведомления"""
+        return {
+            "chat_id": self._target_chat(),
             "text": text,
             "parse_mode": "HTML",
             "disable_web_page_preview": True
         }
+    
+    async def _outbox_begin(self, kind: str, text: str) -> Tuple[Optional[str], bool]:
+        """Записывает уведомление в outbox до доставки
         
-        max_retries = 5
+        Возвращает (ключ записи, нужно ли доставлять). Ключ строится из
+        комментария, который сейчас обрабатывается, чата назначения, вида и
+        текста уведомления.
+        """
+        if not self.outbox:
+            return None, True
+        digest = hashlib.sha256(f"{current_comment.get()}|{self._target_chat()}|{text}".encode()).hexdigest()[:32]
+        key = f"{kind}:{digest}"
+        return key, await self.outbox.append(key, 'sendMessage', self._message_payload(text))
+    
+    def _outbox_finish(self, key: Optional[str], delivered: bool):
+        """Отмечает результат доставки в outbox"""
+        if not self.outbox or not key:
+            return
+        if delivered:
+            self.outbox.mark_done(key)
+        else:
+            self.outbox.release(key)
+    
+    async def _replay_outbox(self):
+        """Доставляет записи outbox, оставшиеся после перезапуска или исчерпания ретраев"""
+        older_than = 0.0
+        while True:
+            pending = await self.outbox.pending(older_than)
+            if pending:
+                logger.info(f"Outbox: повторная доставка {len(pending)} уведомлений")
+            for key, method, payload in pending:
+                if not self.outbox.claim(key):
+                    continue
+                try:
+                    result = await self._call_bot_api(
+                        method, BotApiClient.json_request(payload), max_retries=3, chat_id=payload.get('chat_id')
+                    )
+                except BotApiError as e:
+                    logger.error(f"Outbox: Bot API отверг уведомление {key}, повторов не будет: {e}")
+                    self.outbox.mark_failed(key)
+                    continue
+                self._outbox_finish(key, result is not None)
+            # Дальше повторяем только то, что висит дольше интервала
+            older_than = self.config.outbox_retry_interval
+            await asyncio.sleep(self.config.outbox_retry_interval)
+    
+    async def _call_bot_api(
+        self,
+        method: str,
+        request,
+        max_retries: int,
+        bot: Optional[BotSlot] = None,
+        chat_id: Optional[int] = None
+    ) -> Optional[dict]:
+        """Единая точка вызова Bot API: выбор бота, планировщик лимитов и политика ретраев
+        
+        request - kwargs для session.post (например, BotApiClient.json_request)
+        либо функция, собирающая их на каждую попытку (FormData одноразовая).
+        Без bot каждая попытка уходит через наименее загруженного бота пула; bot
+        закрепляет вызов (нужно для file_id, полученных этим ботом). Бот успешного
+        вызова сохраняется в current_bot. chat_id по умолчанию - текущий чат
+        назначения. Возвращает поле result ответа или None, если все попытки
+        исчерпаны; неустранимую ошибку (повтор получит тот же ответ) пробрасывает
+        как BotApiError.
+        """
+        chat_id = chat_id or self._target_chat()
+        
+        stage = "send_message" if method == 'sendMessage' else "upload"
         for attempt in range(1, max_retries + 1):
+            if attempt > 1:
+                metrics.retries.inc(method)
+            attempt_bot = bot or self.bot_pool.select(chat_id)
+            waited = await attempt_bot.scheduler.acquire(chat_id)
+            if waited > 1:
+                delivery_log.info("   ⏳ %s: ожидание лимита Bot API %.1f с", method, waited)
+            
+            started = time.monotonic()
             try:
-                async with self.http_session.post(url, json=payload) as response:
-                    if response.status == 200:
-                        logger.info("Уведомление успешно отправлено")
-                        return
-                    else:
-                        error_text = await response.text()
-                        logger.warning(
-                            f"Попытка {attempt}/{max_retries}: "
-                            f"Ошибка отправки (status {response.status}): {error_text}"
-                        )
-            except Exception as e:
-                logger.warning(f"Попытка {attempt}/{max_retries}: Ошибка отправки: {e}")
+                result = await self.bot_api.call(
+                    attempt_bot.token, method, request() if callable(request) else request
+                )
+            except BotApiError as e:
+                error = e
+            else:
+                metrics.stage_seconds.observe(time.monotonic() - started, stage)
+                message_time = current_message_time.get()
+                if message_time:
+                    metrics.end_to_end_seconds.observe(time.time() - message_time)
+                current_bot.set(attempt_bot)
+                return result
             
-            # Если это не последняя попытка, ждем с экспоненциальной задержкой
-            if attempt < max_retries:
-                delay = 2 ** (attempt - 1)  # 1s, 2s, 4s, 8s, 16s
-                logger.info(f"Повтор через {delay} секунд...")
+            delivery_log.warning("   Попытка %s/%s: Ошибка %s", attempt, max_retries, error)
+            if error.kind == "fatal":
+                # Повтор того же запроса получит тот же ответ
+                delivery_log.error("   %s: неустранимая ошибка Bot API, повторов не будет", method)
+                raise error
+            if error.kind == "retry_after":
+                # Telegram сообщил точное время ожидания - бот ждет ровно его,
+                # а следующая попытка уйдет через другого бота пула, если он свободен
+                attempt_bot.scheduler.pause(chat_id, error.retry_after)
+                delivery_log.info("   Лимит Bot API (429), пауза %s с", error.retry_after)
+            elif attempt < max_retries:
+                delay = 2 ** (attempt - 1)  # 1s, 2s, 4s, 8s
+                delivery_log.info("   Повтор через %s секунд...", delay)
                 await asyncio.sleep(delay)
         
-        logger.error(
-            f"Не удалось отправить уведомление после {max_retries} попыток"
-        )
+        return None
     
     async def run(self):
         """Запуск мониторинга"""
         try:
             await self.setup()
-            await self.client.run_until_disconnected()
+            await asyncio.gather(*(self._run_shard(shard) for shard in self.shards if shard.available))
         finally:
-            if self.http_session:
-                await self.http_session.close()
+            await self._shutdown()
+    
+    async def _run_shard(self, shard: SessionShard):
+        """Держит сессию подключенной; если она отключилась насовсем, ее каналы переезжают"""
+        await shard.client.run_until_disconnected()
+        if shard.available and len(self.ring) > 1:
+            logger.error(f"Сессия {shard.name} отключилась, переносим ее каналы на другие аккаунты")
+            shard.available = False
+            self.ring.remove(shard.name)
+            await self._rebalance()
+    
+    async def _shutdown(self):
+        """Останавливает конвейер и сохраняет состояние"""
+        await self._stop_workers()
+        if self.digest:
+            await self.digest.flush_all()
+        await self.checkpoints.save()
+        if self.outbox:
+            await self.outbox.close()
+        if self.trace:
+            await self.trace.close()
+        await self.file_id_cache.save()
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        await self.bot_api.close()
 
 
 async def main():
@@ -638,18 +4289,49 @@ async def main():
     logger.info("=" * 50)
     
     # Загружаем конфигурацию
-    config = Config()
+    with startup_profile.phase("config"):
+        config = Config()
+    # Дальше записи логов уходят в stdout из отдельного потока
+    log_listener = configure_logging(config)
+    try:
+        await run_monitor(config)
+    finally:
+        # Дописываем накопившиеся в очереди записи перед выходом
+        log_listener.stop()
+
+
+async def run_monitor(config: Config):
+    """Запуск монитора с загруженной конфигурацией"""
     logger.info(f"Конфигурация загружена:")
     logger.info(f"  - Timezone: {config.timezone}")
     logger.info(f"  - Каналов для мониторинга: {len(config.channels)}")
+    logger.info(f"  - Сессий в пуле: {len(config.string_sessions)}")
     logger.info(f"  - Каналы: {', '.join(config.channels)}")
+    logger.info(f"  - Воркеров доставки: {config.delivery_workers}")
+    logger.info(f"  - Логирование: {logging.getLevelName(config.log_level)}, формат {config.log_format}")
+    logger.info(f"  - Event loop: {type(asyncio.get_running_loop()).__module__}")
+    
+    # systemd и docker останавливают процесс SIGTERM: отменяем run(), чтобы
+    # _shutdown отправил накопленные дайджесты и сохранил состояние
+    main_task = asyncio.current_task()
+    for stop_signal in (signal.SIGTERM, signal.SIGINT):
+        try:
+            asyncio.get_running_loop().add_signal_handler(stop_signal, main_task.cancel)
+        except (NotImplementedError, AttributeError):
+            # Windows: остается KeyboardInterrupt
+            pass
     
     # Создаем и запускаем монитор
-    monitor = CommentMonitor(config)
-    await monitor.run()
+    with startup_profile.phase("init"):
+        monitor = CommentMonitor(config)
+    try:
+        await monitor.run()
+    except asyncio.CancelledError:
+        logger.info("Получен сигнал остановки, монитор остановлен")
 
 
 if __name__ == "__main__":
+    install_event_loop(os.getenv("EVENT_LOOP", "auto").strip().lower())
     try:
         asyncio.run(main())
     except KeyboardInterrupt: